@@ -0,0 +1,101 @@
+import chess
+
+import engine_search
+import engine_utils as utils
+from engine_ucioption import *
+
+from time import perf_counter
+
+# The positions searched by `bench`. Changing this list changes the signature.
+BENCH_FENS = [
+    chess.STARTING_FEN,
+    "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+    "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+    "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP1B1PPP/R2QKB1R w KQ - 0 8",
+    "4rrk1/pp1n3p/3q2pQ/2p1pb2/2PP4/2P3N1/P2B2PP/4RRK1 b - - 7 19",
+    "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+    "6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1",
+    "8/8/4kpp1/3p1b2/p6P/2B5/6P1/6K1 b - - 2 47",
+]
+
+DEFAULT_DEPTH = 4
+
+
+def bench(depth: int = DEFAULT_DEPTH, leafNodes: int = None, fens: list = None):
+    """
+    Search each position of the suite to a fixed depth, from a cleared hash, and report the totals.
+    Leaf nodes are evaluated by the external engine (the ENGINE_PATH option) with `leafNodes` nodes each.
+    The total node count is the signature: the bench runs on one thread (whatever the Threads option), so with
+    a deterministic external engine it only changes when the behaviour of the search does, and it can be
+    compared between versions.
+    :return: the signature
+    """
+    if fens is None:
+        fens = BENCH_FENS
+    if leafNodes is None:
+        leafNodes = option("Nodes")
+
+    saved_nodes, saved_threads = option("Nodes"), option("Threads")
+    setoption("Nodes", str(leafNodes))
+    # Lazy SMP helpers share the hash, which makes the node count vary from run to run
+    setoption("Threads", "1")
+
+    nodes = 0
+    evals_before = engine_search.eval_stats().calls
+    probes_before, hits_before = engine_search.ttTable.probes, engine_search.ttTable.hits
+    start = perf_counter()
+    try:
+        for i, fen in enumerate(fens, start=1):
+            utils.send(f"info string Position {i}/{len(fens)}: {fen}")
+            engine_search.clear()
+            # search_main iterates up to depth - 1
+            engine_search.search_main(chess.Board(fen), depth=depth + 1)
+            nodes += engine_search.NODES
+    finally:
+        setoption("Nodes", str(saved_nodes))
+        setoption("Threads", str(saved_threads))
+    elapsed = perf_counter() - start
+
+    evals = engine_search.eval_stats().calls - evals_before
+    probes = engine_search.ttTable.probes - probes_before
+    hits = engine_search.ttTable.hits - hits_before
+
+    utils.send("\n===========================")
+    utils.send(f"Depth           : {depth}")
+    utils.send(f"Leaf nodes      : {leafNodes}")
+    utils.send(f"Total time (ms) : {int(elapsed * 1000)}")
+    utils.send(f"Nodes searched  : {nodes}")
+    utils.send(f"Eval calls      : {evals}")
+    utils.send(f"TT hit rate     : {hits / probes * 100 if probes else 0:.1f}% ({hits}/{probes})")
+    utils.send(f"Nodes/second    : {int(nodes / elapsed) if elapsed else 0}")
+    utils.send(f"Signature       : {nodes}")
+    return nodes
+
+
+def parse_args(args: list):
+    """Parse `bench [depth] [leafNodes]`. Invalid values fall back to the defaults."""
+    depth, leafNodes = DEFAULT_DEPTH, None
+    try:
+        if len(args) > 0:
+            depth = int(args[0])
+        if len(args) > 1:
+            leafNodes = int(args[1])
+    except ValueError:
+        pass
+    return depth, leafNodes
+
+
+def main(args: list):
+    """CLI entry point: `engine_bench.py [depth] [leafNodes] [enginePath]`."""
+    import engine_engine
+    if len(args) > 2:
+        setoption("ENGINE_PATH", args[2])
+    try:
+        bench(*parse_args(args[:2]))
+    finally:
+        engine_engine.close_evaluators()
+
+
+if __name__ == "__main__":
+    import sys
+    main(sys.argv[1:])
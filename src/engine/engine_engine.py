@@ -1,46 +1,136 @@
 import chess, chess.engine
 
 from engine_ucioption import *
-from engine_search_h import Value
+from engine_search_h import score_to_value
 
-def __engine__(fen: str = None, depth: int = None, nodes: int = None, time: int = None, mate: int = None):
+import threading
+from time import perf_counter
+
+
+class EvalStats:
+    """Latency statistics of the calls made to an evaluator. Times are in seconds."""
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.restarts = 0
+
+    def add(self, elapsed: float):
+        self.calls += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def avg_time(self):
+        return self.total_time / self.calls if self.calls else 0.0
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.total_time += other.total_time
+        self.max_time = max(self.max_time, other.max_time)
+        self.restarts += other.restarts
+
+    def __str__(self):
+        return f"evals {self.calls} avg {self.avg_time() * 1000:.2f}ms max {self.max_time * 1000:.2f}ms" \
+               f" restarts {self.restarts}"
+
+
+class Evaluator:
+    """
+    A persistent external engine process, used for evaluating leaf nodes.
+    The process is started on first use and kept open, so the cost of each call is only the
+    engine's search time. It is restarted when the engine options change or when it crashes.
+    """
+    def __init__(self):
+        self.engine = None
+        self.config = None
+        self.stats = EvalStats()
+        self.lock = threading.Lock()
+        EVALUATORS.append(self)
+
+    @staticmethod
+    def current_config():
+        return option("ENGINE_PATH"), option("Engine Threads")
+
+    def start(self):
+        self.close()
+        self.config = self.current_config()
+        ENGINE_PATH, threads = self.config
+        self.engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
+        self.engine.configure({"Threads": threads})  # Hash is not used here, as it is for our ttTable
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, info=chess.engine.INFO_ALL):
+        with self.lock:
+            if self.engine is None or self.config != self.current_config():
+                self.start()
+
+            start = perf_counter()
+            try:
+                # A constant `game` means `ucinewgame` is only sent once, so the engine stays warm.
+                result = self.engine.analyse(board, limit, game=self, info=info)
+            except chess.engine.EngineTerminatedError:
+                self.stats.restarts += 1
+                self.start()
+                result = self.engine.analyse(board, limit, game=self, info=info)
+            self.stats.add(perf_counter() - start)
+            return result
+
+    def close(self):
+        if self.engine is None:
+            return
+        try:
+            self.engine.quit()
+        except Exception:
+            self.engine.close()
+        self.engine = None
+
+
+# All evaluators, so that their processes can be shut down
+EVALUATORS = []
+
+# The default evaluator, used by the main search thread
+EVALUATOR = Evaluator()
+
+
+def __engine__(fen: str = None, depth: int = None, nodes: int = None, time: int = None, mate: int = None,
+               evaluator: Evaluator = None):
     """
     fen: FEN string
     depth: depth to search to
     nodes: number of nodes to search
     time: time to search for
     """
-    
-    # UCI options
-    ENGINE_PATH = option("ENGINE_PATH")
-    engine_options = {
-        "Threads": option("Threads")
-        # Hash is not used here, as it is for our ttTable
-    }
-    
-    # 1. Create a new engine
-    engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
-    
-    # Set options
-    for name, value in engine_options.items():
-        engine.configure({name: value})
-    
-    # 2. Create board
+
+    if evaluator is None:
+        evaluator = EVALUATOR
+
+    # 1. Create board
     board = chess.Board(fen)
-    
-    # 3. Create a new limit
+
+    # 2. Create a new limit
     limit = chess.engine.Limit(depth=depth, nodes=nodes, time=time, mate=mate)
-    
-    # 4. Evaluate with engine
-    result = engine.analyse(board, limit)
-    
-    # 5. Close the engine
-    engine.quit()
-    
-    # 6. Return the info
-    return result
-
-
-def evaluate(pos, nodes: int):
-    info = __engine__(fen=pos.fen(), nodes=nodes)
-    return Value(info["score"].relative.score(mate_score=1000000))
+
+    # 3. Evaluate with the (persistent) engine
+    return evaluator.analyse(board, limit)
+
+
+def evaluate(pos, nodes: int, ply: int = 0, evaluator: Evaluator = None):
+    """:return: the score of `pos` as an int from the side to move's POV, `ply` plies from the root."""
+    if evaluator is None:
+        evaluator = EVALUATOR
+
+    # Only the score is needed, so we skip parsing the rest of the info.
+    info = evaluator.analyse(pos.copy(stack=False), chess.engine.Limit(nodes=nodes), info=chess.engine.INFO_SCORE)
+    return score_to_value(info["score"].relative, ply)
+
+
+def close_evaluator(evaluator: Evaluator):
+    """Shut down an evaluator that is no longer needed."""
+    evaluator.close()
+    if evaluator in EVALUATORS and evaluator is not EVALUATOR:
+        EVALUATORS.remove(evaluator)
+
+
+def close_evaluators():
+    """Shut down the external engine processes."""
+    for evaluator in EVALUATORS:
+        evaluator.close()
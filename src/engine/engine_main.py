@@ -4,4 +4,9 @@ def main():
     engine_uci.uci()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        import engine_bench
+        engine_bench.main(sys.argv[2:])
+    else:
+        main()
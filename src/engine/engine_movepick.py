@@ -0,0 +1,150 @@
+import chess
+
+from engine_search_h import MAX_PLY
+
+# Piece values for MVV-LVA, indexed by piece type
+PIECE_VALUES = [0, 100, 320, 330, 500, 900, 0]
+
+HISTORY_MAX = 16384
+
+
+class ButterflyHistory:
+    """History of quiet moves, indexed by [color][from][to].
+    Moves that cause beta cutoffs get a bonus, the other quiet moves tried before them get a malus."""
+    def __init__(self):
+        self.table = [[0] * 4096, [0] * 4096]
+
+    def get(self, color: chess.Color, move: chess.Move):
+        return self.table[color][move.from_square << 6 | move.to_square]
+
+    def update(self, color: chess.Color, move: chess.Move, bonus: int):
+        bonus = max(-HISTORY_MAX, min(bonus, HISTORY_MAX))
+        t = self.table[color]
+        i = move.from_square << 6 | move.to_square
+        # Gravity: keep the values within [-HISTORY_MAX, HISTORY_MAX]
+        t[i] += bonus - t[i] * abs(bonus) // HISTORY_MAX
+
+    def age(self):
+        """Halve all values, so that older searches count less."""
+        for t in self.table:
+            for i in range(4096):
+                t[i] //= 2
+
+    def clear(self):
+        self.__init__()
+
+
+class Killers:
+    """Two killer moves (quiet moves that caused a beta cutoff) per ply."""
+    def __init__(self):
+        self.moves = [[None, None] for _ in range(MAX_PLY + 1)]
+
+    def get(self, ply: int):
+        return self.moves[min(ply, MAX_PLY)]
+
+    def update(self, ply: int, move: chess.Move):
+        k = self.moves[min(ply, MAX_PLY)]
+        if k[0] != move:
+            k[1] = k[0]
+            k[0] = move
+
+    def clear(self):
+        self.__init__()
+
+
+def is_quiet(pos: chess.Board, move: chess.Move):
+    return not pos.is_capture(move) and move.promotion is None
+
+
+def mvv_lva(pos: chess.Board, move: chess.Move):
+    """Most valuable victim, least valuable attacker. Promotions count as winning the promoted piece."""
+    victim = chess.PAWN if pos.is_en_passant(move) else pos.piece_type_at(move.to_square)
+    score = PIECE_VALUES[victim] * 8 if victim else 0
+    if move.promotion:
+        score += PIECE_VALUES[move.promotion] * 8
+    return score - PIECE_VALUES[pos.piece_type_at(move.from_square)] // 100
+
+
+class MovePicker:
+    """
+    Yields the legal moves of a position in the order they should be searched:
+    1. the TT move
+    2. captures and promotions, by MVV-LVA
+    3. killer moves
+    4. quiet moves, by butterfly history
+    Since every node costs an external engine evaluation, good ordering directly saves time.
+    """
+    def __init__(self, pos: chess.Board, ttMove: chess.Move = None, killers: list = (),
+                 history: ButterflyHistory = None):
+        self.pos = pos
+        self.ttMove = ttMove
+        self.killers = killers
+        self.history = history
+
+    def __iter__(self):
+        pos = self.pos
+        ttMove = self.ttMove
+        captures = []
+        quiets = []
+        for move in pos.legal_moves:
+            if move == ttMove:
+                continue
+            if is_quiet(pos, move):
+                quiets.append(move)
+            else:
+                captures.append(move)
+
+        if ttMove is not None and pos.is_legal(ttMove):
+            yield ttMove
+
+        captures.sort(key=lambda m: mvv_lva(pos, m), reverse=True)
+        yield from captures
+
+        for killer in self.killers:
+            if killer is not None and killer in quiets:
+                quiets.remove(killer)
+                yield killer
+
+        if self.history is not None:
+            color = pos.turn
+            quiets.sort(key=lambda m: self.history.get(color, m), reverse=True)
+        yield from quiets
+
+
+def bench_ordering(depth: int = 4, fens: list = None):
+    """Compare the node counts of a fixed-depth search with and without move ordering.
+    This runs real searches, so it uses the external engine set by the ENGINE_PATH option."""
+    import engine_search
+    import engine_utils as utils
+
+    if fens is None:
+        fens = [
+            chess.STARTING_FEN,
+            "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+            "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+            "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+            "6k1/5ppp/8/8/8/8/5PPP/R5K1 w - - 0 1",
+        ]
+
+    totals = {}
+    for ordering in (False, True):
+        engine_search.MOVE_ORDERING = ordering
+        totals[ordering] = 0
+        for fen in fens:
+            engine_search.clear()
+            # search_main iterates up to depth - 1
+            engine_search.search_main(chess.Board(fen), depth=depth + 1)
+            utils.send(f"info string ordering {ordering} nodes {engine_search.NODES} fen {fen}")
+            totals[ordering] += engine_search.NODES
+    engine_search.MOVE_ORDERING = True
+
+    utils.send(f"info string total nodes without ordering {totals[False]}, with ordering {totals[True]}")
+
+
+if __name__ == "__main__":
+    import sys
+    import engine_engine
+    try:
+        bench_ordering(int(sys.argv[1]) if len(sys.argv) > 1 else 4)
+    finally:
+        engine_engine.close_evaluators()
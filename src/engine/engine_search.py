@@ -6,162 +6,336 @@ from engine_search_h import *
 from engine_ucioption import *
 from engine_timeman import *
 import engine_tt as tt
-from engine_zobrist import Zobrist as Zo
+from engine_zobrist import Position
+from engine_movepick import MovePicker, ButterflyHistory, Killers, is_quiet
 
-from time import time as time_now
+from time import time as time_now, sleep
 import threading
 import math
 
 STOP_SEARCH = OPTTIME = MAXTIME = False
+PONDER = False  # searching on the opponent's time, until `ponderhit` or `stop`
 NODES = 0
+CHECK_INTERVAL = 8  # nodes between time checks; the stop flag itself is read at every node
+optDeadline = maxDeadline = nodesLimit = None
+ponderTimes = (0, 0)  # the (optimal, maximum) time of a ponder search, applied on ponderhit
 default_nodes = option("Nodes")
 
-ttTable = tt.TranspositionTable(size=option("Hash"))
+ttTable = tt.TranspositionTable(size=option("Hash"))  # size in MB
 
 PV = []
+MOVE_ORDERING = True
 
-# Objects
-Z = Zo()
-last_output = time_now()
+startTime = last_output = time_now()
 
-def search(pos: chess.Board, depth: int, alpha: Value, beta: Value, 
-           PvNode: bool = False, rootNode: bool = False):
+# Lazy SMP: helper threads skip some depths, so that they do not all search the same tree
+SKIP_SIZE = [1, 1, 2, 2, 2, 2, 3, 3, 3, 3, 3, 3, 4, 4, 4, 4, 4, 4, 4, 4]
+SKIP_PHASE = [0, 1, 0, 1, 2, 3, 0, 1, 2, 3, 4, 5, 0, 1, 2, 3, 4, 5, 6, 7]
+
+
+class StopSearch(Exception):
+    """Raised inside the search to unwind it as soon as the search has to stop."""
+
+
+def check_time():
+    """Poll the time and node limits of the current search."""
+    global STOP_SEARCH, OPTTIME, MAXTIME
+
+    now = time_now()
+    if maxDeadline and now >= maxDeadline:
+        STOP_SEARCH = MAXTIME = True
+    if optDeadline and now >= optDeadline:
+        OPTTIME = True
+    if nodesLimit and total_nodes() >= nodesLimit:
+        STOP_SEARCH = True
+
+
+def total_nodes():
+    return sum(w.nodes for w in workers)
+
+
+class Worker:
     """
-    Good, old-fashioned alpha-beta search.
+    The state of one search thread. Worker 0 is the main thread; the others are Lazy SMP helpers.
+    All workers share the transposition table, but each has its own evaluator process,
+    so that the time spent waiting for external evaluations overlaps.
     """
-    global NODES, ttTable, PV, last_output
+    def __init__(self, idx: int):
+        self.idx = idx
+        self.evaluator = EVALUATOR if idx == 0 else Evaluator()
+        self.killers = Killers()
+        self.history = ButterflyHistory()
+        self.nodes = 0
+        self.rootPly = 0
+        self.rootBestMoves = []
+        self.bestMove = None
+        self.completedDepth = 0
+
+    def clear(self):
+        self.killers.clear()
+        self.history.clear()
+
+    def search(self, pos: Position, depth: int, alpha: int, beta: int,
+               PvNode: bool = False, rootNode: bool = False):
+        """
+        Good, old-fashioned alpha-beta search.
+        Scores are plain ints from the side to move's POV (see engine_search_h for the mate encoding).
+        """
+        global last_output
+
+        self.nodes += 1
+        if self.idx == 0 and self.nodes % CHECK_INTERVAL == 0:
+            check_time()
+        if STOP_SEARCH:
+            raise StopSearch
+        ply = pos.ply() - self.rootPly
+
+        if depth <= 0:
+            return evaluate(pos, default_nodes, ply, self.evaluator)
+
+        # Init
+        PvNode = rootNode or PvNode  # rootNode is PV
+
+        posKey = pos.key  # updated incrementally by Position.push/pop
+        ttEntry = ttTable.probe(posKey)
+        ttHit: bool = not ttEntry.is_none()
+        ttValue = value_from_tt(ttEntry.value, ply) if ttHit and ttEntry.value is not None else None
+        ttEval = value_from_tt(ttEntry.eval, ply) if ttHit and ttEntry.eval is not None else None
+        ttDepth = ttEntry.depth if ttHit else 0
+        ttMove = ttEntry.move if ttHit else None
+
+        staticEval = Eval = None
+        if ttHit:
+            staticEval = Eval = ttEval
+            if staticEval is None:
+                staticEval = Eval = evaluate(pos, default_nodes, ply, self.evaluator)
+
+            # ttValue can be used as a better position evaluation
+            if ttValue is not None:
+                Eval = ttValue
 
-    NODES += 1
+        else:
+            staticEval = Eval = evaluate(pos, default_nodes, ply, self.evaluator)
+            # Save staticEval to tt
+            ttTable.save(posKey, eval=value_to_tt(staticEval, ply), depth=0)
+
+        bestValue = -VALUE_INFINITE
+        bestMove = None
+        alphaOrig = alpha
+        value = None
+
+        # Moves loop
+        moveCount = 0
+        quietsSearched = []
+        moves = MovePicker(pos, ttMove, self.killers.get(ply), self.history) if MOVE_ORDERING else pos.legal_moves
+        for move in moves:
+            moveCount += 1
+
+            if rootNode and self.idx == 0:
+                # currmove output
+                elapsed = int( (time_now() - last_output) * 1000 )
+                if elapsed >= 3000:
+                    nps = int( total_nodes() / (elapsed / 1000) )
+                    utils.send(f"info currmove {move} currmovenumber {moveCount} nps {nps} hashfull {ttTable.hashfull()}")
+                    last_output = time_now()
+
+            # Extensions
+            extension = 0
+            if ttHit and move == ttMove and depth >= 4 and ttDepth >= depth - 3:
+                singularBeta = ttValue - 2 * depth
+                value = self.search(pos, (depth - 1) // 2, singularBeta-1, singularBeta, False)
+                if value < singularBeta:
+                    extension = 1
+                    if not PvNode and value <= singularBeta - 10:
+                        extension = 2
+
+                if ttValue >= beta:
+                    extension = -2
+                elif ttValue <= value:
+                    extension = -1
+                elif depth > 6 and Eval - 100:
+                    extension = -1
+            else:
+                # Check extensions
+                if pos.gives_check(move) and depth >= 8:
+                    extension = 1
+
+            newDepth = depth - 1 + extension
+
+            # Make the move
+            pos.push(move)
+
+            # Reductions
+            r = 0
+            if PvNode: r -= 1
+            if move == ttMove: r += 1
+
+            # LMR (only when there is depth left to reduce, otherwise we would never reach the leaves)
+            d = clamp(newDepth - r, 1, newDepth+1) if depth >= 2 else newDepth
+            value = -self.search(pos, d, -(alpha+1), -alpha, False)
+
+            # TODO: Do a full-depth search when reduced LMR search fails high
+
+            # For PV nodes only, do a full PV search on the first move
+            # or after a fail high (in the latter case search only if value < beta)
+            if PvNode and value > alpha and (rootNode or value < beta):
+                value = -self.search(pos, newDepth, -beta, -alpha, True)
+
+            # Undo move
+            pos.pop()
+
+            if value > bestValue:
+                bestValue = value
+                if value > alpha:
+                    bestMove = move
+                    if PvNode and not rootNode:
+                        # TODO: Update PV
+                        pass
+                    if value >= beta:
+                        # Fail high
+                        if is_quiet(pos, move):
+                            self.update_quiet_stats(pos, ply, move, quietsSearched, depth)
+                        break
+                    else:
+                        alpha = value
+
+            if move != bestMove and is_quiet(pos, move):
+                quietsSearched.append(move)
+
+        # End of moves loop
+
+        # Checkmate or stalemate
+        if moveCount == 0:
+            bestValue = mated_in(ply) if pos.is_check() else VALUE_DRAW
+
+        # Write gathered information in transposition table
+        bound = tt.BOUND_LOWER if bestValue >= beta else \
+                tt.BOUND_EXACT if PvNode and bestValue > alphaOrig else tt.BOUND_UPPER
+        ttTable.save(posKey, move=bestMove, value=value_to_tt(bestValue, ply), eval=value_to_tt(Eval, ply),
+                     depth=depth, bound=bound)
 
-    if depth <= 0:
-        return evaluate(pos, default_nodes)
-    
-    # Init
-    PvNode = rootNode or PvNode  # rootNode is PV
-
-    ttEntry = ttTable.get(pos)
-    ttHit: bool = not ttEntry.is_none()
-    ttValue = ttEntry.value if ttHit else None
-    ttEval = ttEntry.eval if ttHit else None
-    ttDepth = ttEntry.depth if ttHit else 0
-    ttMove = ttEntry.move if ttHit else None
-
-    posKey = Z.hash(pos)
-
-    staticEval = Eval = None
-    if ttHit:
-        staticEval = Eval = ttEval
-        if staticEval is None:
-            staticEval = Eval = evaluate(pos, default_nodes)
-        
-        # ttValue can be used as a better position evaluation
-        if ttValue is not None:
-            Eval = ttValue
-    
-    else:
-        staticEval = Eval = evaluate(pos, default_nodes)
-        # Save staticEval to tt
-        tte = ttTable.TTEntry(posKey, move=None, value=None, eval=staticEval, depth=0)
-        ttTable.save(posKey, tte)
-    
-    bestValue = -VALUE_INFINITE
-    bestMove = None
-    value = None
+        if rootNode:
+            self.rootBestMoves.append(bestMove)
 
-    # Moves loop
-    moveCount = 0
-    for move in pos.legal_moves:
-        moveCount += 1
+        return bestValue
+
+
+    def update_quiet_stats(self, pos: Position, ply: int, move: chess.Move, quietsSearched: list, depth: int):
+        """Update killers and history after a quiet move caused a beta cutoff."""
+        bonus = depth * depth
+        self.killers.update(ply, move)
+        self.history.update(pos.turn, move, bonus)
+        for quiet in quietsSearched:
+            self.history.update(pos.turn, quiet, -bonus)
+
+    def iterative_deepening(self, pos: Position, depth: int):
+        """Search `pos` with increasing depth, until `depth` or until the search is stopped.
+        Only the main thread reports info and decides whether to start another iteration."""
+        global last_output
+
+        self.rootPly = pos.ply()
+        self.nodes = 0
+        self.rootBestMoves = []
+        self.completedDepth = 0
+        self.killers.clear()
+        self.history.age()
+
+        # Fall back to any legal move if not even depth 1 completes
+        self.bestMove = next(iter(pos.legal_moves), None)
+
+        alpha = -VALUE_INFINITE
+        beta = VALUE_INFINITE
+
+        for rootDepth in range(1, depth):
+            if self.idx > 0:
+                i = (self.idx - 1) % len(SKIP_SIZE)
+                if ((rootDepth + self.rootPly + SKIP_PHASE[i]) // SKIP_SIZE[i]) % 2:
+                    continue
+
+            try:
+                bestValue = self.search(pos, rootDepth, alpha, beta, True, True)
+            except StopSearch:
+                break
+
+            self.completedDepth = rootDepth
+            if self.rootBestMoves[-1] is not None:
+                self.bestMove = self.rootBestMoves[-1]
+            if bestValue <= alpha:
+                beta = (alpha + beta) // 2
+                alpha = max(bestValue - 10, -VALUE_INFINITE)
+            elif bestValue >= beta:
+                beta = min(bestValue + 10, VALUE_INFINITE)
+
+            if self.idx != 0:
+                continue
+
+            nodes = total_nodes()
+            elapsed = max( int( (time_now() - startTime) * 1000 ), 1 )
+            nps = int( nodes / (elapsed / 1000) )
+
+            utils.send(f"info depth {rootDepth} score {Value(bestValue).__uci_str__()} nodes {nodes} "
+                       f"nps {nps} hashfull {ttTable.hashfull()} time {elapsed} pv {self.bestMove}")
+            if option("debug"):
+                utils.send(f"info string {eval_stats()}")
+            last_output = time_now()
+
+            # Don't start a new iteration after the optimal time
+            check_time()
+            if STOP_SEARCH or OPTTIME:
+                break
+
+
+workers = [Worker(0)]
+
+
+def set_workers(n: int):
+    """Resize the thread pool to `n` workers (the `Threads` option)."""
+    while len(workers) < n:
+        workers.append(Worker(len(workers)))
+    while len(workers) > n:
+        close_evaluator(workers.pop().evaluator)
+
+
+def eval_stats():
+    stats = EvalStats()
+    for w in workers:
+        stats.merge(w.evaluator.stats)
+    return stats
+
+
+def clear():
+    """Clear the transposition table and the move ordering statistics, e.g. for a new game."""
+    ttTable.clear()
+    for w in workers:
+        w.clear()
 
-        if rootNode:
-            # currmove output
-            elapsed = int( (time_now() - last_output) * 1000 )
-            if elapsed >= 3000:
-                nps = int( NODES / (elapsed / 1000) )
-                print(f"info currmove {move} currmovenumber {moveCount} nps {nps}")
-                last_output = time_now()
-
-        # Extensions
-        extension = 0
-        if ttHit and move == ttMove and depth >= 4 and ttDepth >= depth - 3:
-            singularBeta = ttValue - 2 * depth
-            value = search(pos, (depth - 1) // 2, singularBeta-1, singularBeta, False)
-            if value < singularBeta:
-                extension = 1
-                if not PvNode and value <= singularBeta - 10:
-                    extension = 2
-
-            if ttValue >= beta:
-                extension = -2
-            elif ttValue <= value:
-                extension = -1
-            elif depth > 6 and Eval - 100:
-                extension = -1
-        else:
-            # Check extensions
-            if pos.gives_check(move) and depth >= 8:
-                extension = 1
-        
-        newDepth = depth + extension
-
-        # Make the move
-        pos.push(move)
-
-        # Reductions
-        r = 0
-        if PvNode: r -= 1
-        if move == ttMove: r += 1
-
-        # LMR
-        d = clamp(newDepth - r, 1, newDepth+1)
-        value = -search(pos, d, -Value(alpha+1), -alpha, False)
-
-        # TODO: Do a full-depth search when reduced LMR search fails high
-
-        # For PV nodes only, do a full PV search on the first move
-        # or after a fail high (in the latter case search only if value < beta)
-        if PvNode and value > alpha and (rootNode or value < beta):
-            value = -search(pos, newDepth, -beta, -alpha, True)
-
-        # Undo move
-        pos.pop()
-
-        if value > bestValue:
-            bestValue = value
-            if value > alpha:
-                bestMove = move
-                if PvNode and not rootNode:
-                    # TODO: Update PV
-                    pass
-                if value >= beta:
-                    # Fail high
-                    break
-                else:
-                    alpha = value
-
-    # End of moves loop
-
-    # Write gathered information in transposition table
-    tte = ttTable.TTEntry(posKey, move=bestMove, value=bestValue, eval=Eval, depth=depth)
-    ttTable.save(posKey, tte)
-
-    if rootNode:
-        PV += [bestMove]
-
-    return bestValue
-    
 
 def search_main(rootPos: chess.Board, MAX_MOVES=5, MAX_ITERS=5, depth: int = None, nodes: int = None, movetime: int = None,
-           mate: int = None, timeman: Time = Time()):
-    global STOP_SEARCH, lastNps
-    global OPTTIME, MAXTIME
-    global NODES, PV, ttTable, last_output
+           mate: int = None, timeman: Time = Time(), started: threading.Event = None, ponder: bool = False):
+    """Iterative deepening on all threads. The search can be stopped at any time (see `stop_search`),
+    in which case the best move of the main thread's last completed depth is reported.
+    `started` is set once the search is initialised, with its start time and deadlines: a stop or ponderhit
+    before that would be overwritten, or would use the previous search's times.
+    With `ponder`, the search has no time limit until `ponderhit` (see `ponderhit`), and `bestmove` is not
+    sent before `ponderhit` or `stop`, even if the search finishes.
+    :return: the best move"""
+    global STOP_SEARCH, PONDER, lastNps
+    global OPTTIME, MAXTIME, optDeadline, maxDeadline, nodesLimit, ponderTimes
+    global NODES, PV, ttTable, startTime
     global default_nodes
 
+    STOP_SEARCH = OPTTIME = MAXTIME = False
+    PONDER = ponder
     default_nodes = option("Nodes")
-    NODES = 0
-    PV = []
-    ttTable = tt.TranspositionTable(option("Hash"))
+    rootBoard = rootPos
+    rootPos = Position.from_board(rootPos)
+    set_workers(option("Threads"))
+    for w in workers:
+        w.nodes = 0
+    # Keep the table between searches; only reallocate if the Hash size has changed
+    if ttTable.mb != option("Hash"):
+        ttTable.resize(option("Hash"))
+    ttTable.new_search()
     
     if depth is None:
         depth = MAX_DEPTH
@@ -174,41 +348,80 @@ def search_main(rootPos: chess.Board, MAX_MOVES=5, MAX_ITERS=5, depth: int = Non
         optTime = maxTime = movetime
 
     startTime = time_now()
-    optTime_timer = maxTime_timer = None
-    
-    # Set timer
-    if optTime:
-        optTime_timer = threading.Timer(optTime / 1000, stop_search, args=(True, False))
-        optTime_timer.start()
-        if option("debug"):
-            print(f"info string Timeman: Optimal time {optTime}ms")
-    if maxTime:
-        maxTime_timer = threading.Timer(maxTime / 1000, stop_search, args=(True, True))
-        maxTime_timer.start()
-    
-    alpha = -VALUE_INFINITE
-    beta = VALUE_INFINITE
-
-    for rootDepth in range(1, depth):
-        bestValue = search(rootPos, rootDepth, alpha, beta, True, True)
-        if bestValue <= alpha:
-            beta = (alpha + beta) // 2
-            alpha = max(bestValue - 10, -VALUE_INFINITE)
-        elif bestValue >= beta:
-            beta = min(bestValue + 10, VALUE_INFINITE)
-        elapsed = max( int( (time_now() - startTime) * 1000 ), 1 )
-        nps = int( NODES / (elapsed / 1000) )
-        
-        print(f"info depth {rootDepth} score cp {bestValue} nodes {NODES}\
-               nps {nps} time {elapsed} pv {PV}")
-        last_output = time_now()
+
+    # Set deadlines, which are polled by the main thread. A ponder search gets them on ponderhit.
+    ponderTimes = (optTime, maxTime)
+    optDeadline = startTime + optTime / 1000 if optTime and not ponder else None
+    maxDeadline = startTime + maxTime / 1000 if maxTime and not ponder else None
+    nodesLimit = nodes
+    # Only now can the search be stopped, or ponderhit, without acting on the previous search's state
+    if started is not None:
+        started.set()
+    if optTime and option("debug"):
+        utils.send(f"info string Timeman: Optimal time {optTime}ms")
+
+    helpers = [threading.Thread(target=w.iterative_deepening, args=(rootPos.copy(), depth), daemon=True)
+               for w in workers[1:]]
+    for t in helpers:
+        t.start()
+
+    main = workers[0]
+    main.iterative_deepening(rootPos, depth)
+
+    # While pondering, the GUI expects no bestmove before ponderhit or stop
+    while PONDER and not STOP_SEARCH:
+        sleep(0.001)
+    PONDER = False
+
+    # The main thread has finished, so stop the helpers
+    STOP_SEARCH = True
+    for t in helpers:
+        t.join()
+
+    NODES = total_nodes()
+    PV = main.rootBestMoves
+    bestMove = main.bestMove
+
+    # A stopped search leaves its moves on rootPos, so start again from the board
+    ponderMove = expected_reply(Position.from_board(rootBoard), bestMove)
+    utils.send(f"bestmove {bestMove.uci() if bestMove else '0000'}" + (f" ponder {ponderMove}" if ponderMove else ""))
+    return bestMove
+
+
+def expected_reply(pos: Position, move: chess.Move):
+    """:return: the opponent's best reply to `move` according to the transposition table, or None.
+    This is the move to ponder on."""
+    if move is None:
+        return None
+    pos.push(move)
+    reply = ttTable.probe(pos.key).move
+    if reply is not None and not pos.is_legal(reply):
+        reply = None
+    pos.pop()
+    return reply
+
+
+def ponderhit():
+    """The opponent played the move we were pondering on, so the ponder search becomes a normal search,
+    keeping its tree, hash and evaluators. The time spent pondering is credited: the optimal time is counted
+    from the start of the ponder search. The clock only started now though, so the maximum time is counted
+    from now."""
+    global PONDER, optDeadline, maxDeadline
+    optTime, maxTime = ponderTimes
+    now = time_now()
+    optDeadline = startTime + optTime / 1000 if optTime else None
+    maxDeadline = now + maxTime / 1000 if maxTime else None
+    PONDER = False
 
 
 def stop_search(optTime=False, maxTime=False):
+    """Signal the search to stop. A hard stop (UCI `stop`, or maximum time) aborts the search
+    within one node; reaching the optimal time only prevents a new iteration from starting."""
     global STOP_SEARCH, OPTTIME, MAXTIME
-    STOP_SEARCH = True
-    
     if optTime:
         OPTTIME = True
     if maxTime:
         MAXTIME = True
+
+    if maxTime or not optTime:
+        STOP_SEARCH = True
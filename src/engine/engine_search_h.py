@@ -7,6 +7,7 @@ class Value:
     """Stores a value in centipawns.
      If `pov` is provided, then it will always be from the perspective of `pov`,
      i.e. larger is always better for `pov`.
+     The search, TT and evaluator work with plain ints; a Value is only built for output.
      """
     value = None
     pov = None
@@ -15,16 +16,12 @@ class Value:
         if type(value) == int:
             self.value = value
         elif type(value) == chess.engine.PovScore and pov is None:
-            self.value = value.relative.score(mate_score=100000)
+            self.value = score_to_value(value.relative)
         elif type(value) == chess.engine.PovScore and pov is not None:
-            self.value = value.white().score(mate_score=100000)
-            if pov == chess.BLACK:
-                self.value = -self.value
+            self.value = score_to_value(value.pov(pov))
             self.pov = pov
-        elif type(value) == chess.engine.Score:
-            self.value = value.score(mate_score=100000)
-        elif type(value) == chess.engine.Cp:
-            self.value = value.score(mate_score=100000)
+        elif isinstance(value, chess.engine.Score):
+            self.value = score_to_value(value)
         self.pov = pov
         
     def __int__(self):
@@ -37,7 +34,7 @@ class Value:
         return utils.cp_to_score(self.value)
     
     def __uci_str__(self):
-        return str(self.value)
+        return value_to_uci(self.value)
     
     def __lt__(self, other):
         if type(other) == int:
@@ -104,5 +101,94 @@ def clamp(value, min_value, max_value):
 
 
 # Constants
-VALUE_INFINITE = 999999
-MAX_DEPTH = 64
\ No newline at end of file
+MAX_DEPTH = 64
+MAX_PLY = 246
+
+VALUE_ZERO = 0
+VALUE_DRAW = 0
+VALUE_MATE = 32000
+VALUE_INFINITE = 32001
+VALUE_NONE = 32002
+
+VALUE_MATE_IN_MAX_PLY = VALUE_MATE - MAX_PLY
+VALUE_MATED_IN_MAX_PLY = -VALUE_MATE_IN_MAX_PLY
+
+
+# Mate scores are encoded as VALUE_MATE minus the distance to mate in plies from the root.
+def mate_in(ply: int):
+    return VALUE_MATE - ply
+
+
+def mated_in(ply: int):
+    return -VALUE_MATE + ply
+
+
+def is_mate_value(v: int):
+    return abs(v) >= VALUE_MATE_IN_MAX_PLY
+
+
+def score_to_value(score: chess.engine.Score, ply: int = 0):
+    """Convert an engine score (side to move's POV) of a node `ply` plies from the root to an int."""
+    mate = score.mate()
+    if mate is None:
+        return clamp(score.score(), VALUE_MATED_IN_MAX_PLY + 1, VALUE_MATE_IN_MAX_PLY - 1)
+    if mate > 0 or (mate == 0 and score > chess.engine.Cp(0)):
+        return mate_in(ply + max(2 * mate - 1, 0))
+    return mated_in(ply - 2 * mate)
+
+
+def value_to_tt(v: int, ply: int):
+    """Mate scores are stored in the TT relative to the node, instead of the root."""
+    if v >= VALUE_MATE_IN_MAX_PLY:
+        return v + ply
+    if v <= VALUE_MATED_IN_MAX_PLY:
+        return v - ply
+    return v
+
+
+def value_from_tt(v: int, ply: int):
+    if v >= VALUE_MATE_IN_MAX_PLY:
+        return v - ply
+    if v <= VALUE_MATED_IN_MAX_PLY:
+        return v + ply
+    return v
+
+
+def value_to_uci(v: int):
+    """:return: 'cp <x>' or 'mate <y>', as in UCI `info score`"""
+    if not is_mate_value(v):
+        return f"cp {v}"
+    if v > 0:
+        return f"mate {(VALUE_MATE - v + 1) // 2}"
+    return f"mate {-(VALUE_MATE + v) // 2}"
+
+
+def bench(nodes: int = 200000, seed: int = 1):
+    """Micro-benchmark: the per-node score handling of negamax (negate, compare, window arithmetic)
+    with Value objects vs plain ints. This is the Python overhead the search pays on top of evaluation."""
+    import random
+    from time import perf_counter
+
+    rng = random.Random(seed)
+    leaves = [rng.randint(-300, 300) for _ in range(nodes)]
+
+    def run(name, values, wrap):
+        start = perf_counter()
+        alpha, beta = wrap(-VALUE_INFINITE), wrap(VALUE_INFINITE)
+        best = wrap(-VALUE_INFINITE)
+        for v in values:
+            value = -v
+            child_alpha = -wrap(alpha + 1)  # null window, as in search()
+            if value > best:
+                best = value
+                if value > alpha and value < beta and child_alpha < beta:
+                    alpha = value
+        elapsed = perf_counter() - start
+        print(f"{name:<8} {nodes / elapsed / 1e6:6.2f}M nodes/s")
+
+    run("Value", [Value(v) for v in leaves], Value)
+    run("int", leaves, int)
+
+
+if __name__ == "__main__":
+    bench()
\ No newline at end of file
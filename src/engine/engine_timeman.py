@@ -56,6 +56,10 @@ class Time:
             0.88 * self.time[us] / timeLeft) * optExtra * startExtra
         maxScale = 6.3
         
+        # With pondering, we also think on the opponent's time, so we can afford more on ours
+        if option("Ponder"):
+            optScale *= 1.25
+        
         # Never use more than 80% of the available time for this move
         self.optTime = max(1, int(optScale * timeLeft))
         self.maxTime = int(min(0.8 * self.time[us] - overhead, maxScale * self.optTime))
@@ -1,47 +1,158 @@
 import engine_zobrist as zobrist
 import chess
 from chess import Board
-from engine_search_h import Value
+from engine_search_h import VALUE_NONE
+
+from array import array
+
+# Bound types
+BOUND_NONE = 0
+BOUND_UPPER = 1
+BOUND_LOWER = 2
+BOUND_EXACT = BOUND_UPPER | BOUND_LOWER
+
+CLUSTER_SIZE = 4  # number of entries in each bucket
+GENERATION_CYCLE = 256
+HASHFULL_SAMPLE = 1000
+
+# key (8), move (2), value (4), eval (4), depth (1), bound (1), generation (1)
+ENTRY_BYTES = 21
+
+
+def encode_move(move: chess.Move):
+    if move is None:
+        return 0
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+
+def decode_move(m: int):
+    if m == 0:
+        return None
+    return chess.Move(m & 63, (m >> 6) & 63, (m >> 12) or None)
+
 
 class TranspositionTable:
+    """
+    A transposition table stored in fixed-width columns (`array`s), instead of one Python object per slot.
+    The table is divided into buckets of CLUSTER_SIZE entries. An entry is replaced based on its depth and
+    age (generation), so the table does not need to be cleared between searches.
+    The size is given in MB, like the `Hash` option of other engines.
+    """
     class TTEntry:
-        # TODO: Add `bound` info.
-        def __init__(self, key=None, move: chess.Move=None, value: Value=None, eval: Value=None,
-                     depth: int=None, is_pv: bool=False):
+        """A read-only view of an entry, returned by `probe`."""
+        __slots__ = ("key", "move", "value", "eval", "depth", "bound", "is_pv")
+
+        def __init__(self, key=None, move: chess.Move=None, value: int=None, eval: int=None,
+                     depth: int=None, bound: int=BOUND_NONE, is_pv: bool=False):
             self.key = key
             self.move = move
             self.value = value
             self.eval = eval
             self.depth = depth
+            self.bound = bound
             self.is_pv = is_pv
-            
+
         def is_none(self):
             return self.key is None
-        
+
+    NONE_ENTRY = TTEntry()
+
     def __init__(self, size: int):
-        self.size = size
-        self.table = [self.TTEntry() for i in range(self.size)]
         self.zobrist = zobrist.Zobrist()
-        
-    def hashfull_count(self):
-        return sum([1 for entry in self.table if not entry.is_none()])
-    
+        self.generation = 0
+        self.probes = self.hits = 0  # statistics for `bench`; not reset by `clear`
+        self.resize(size)
+
+    def resize(self, size: int):
+        """Allocate `size` MB for the table. All entries are cleared."""
+        self.mb = size
+        self.buckets = max(1, size * 1024 * 1024 // (ENTRY_BYTES * CLUSTER_SIZE))
+        self.size = self.buckets * CLUSTER_SIZE
+        self.clear()
+
+    def clear(self):
+        n = self.size
+        self.keys = array('Q', bytes(8 * n))
+        self.moves = array('H', bytes(2 * n))
+        self.values = array('i', bytes(4 * n))
+        self.evals = array('i', bytes(4 * n))
+        self.depths = array('b', bytes(n))
+        self.bounds = array('B', bytes(n))
+        self.generations = array('B', bytes(n))
+        self.generation = 0
+
+    def new_search(self):
+        """Start a new search: entries from older searches become candidates for replacement."""
+        self.generation = (self.generation + 1) % GENERATION_CYCLE
+
+    def first_entry(self, key: int):
+        # Use the high bits of the key for the index, so that the low bits remain useful for verification
+        return ((key * self.buckets) >> 64) * CLUSTER_SIZE
+
+    def hashfull_count(self, sample: int = HASHFULL_SAMPLE):
+        """Count the entries written in the current search, among the first `sample` entries."""
+        generation = self.generation
+        gens = self.generations
+        keys = self.keys
+        return sum(1 for i in range(min(sample, self.size)) if keys[i] and gens[i] == generation)
+
     def hashfull(self):
-        return self.hashfull_count() / self.size
-    
+        """:return: the estimated table usage in permill, as reported by UCI `info hashfull`.
+        Like Stockfish, only the first 1000 entries are sampled, so this is cheap for any table size."""
+        sample = min(HASHFULL_SAMPLE, self.size)
+        return self.hashfull_count(sample) * 1000 // sample
+
     def hash(self, pos: Board):
-        return self.zobrist.hash(pos) % self.size
-    
+        return self.zobrist.hash(pos)
+
     def get(self, pos: Board):
-        return self.table[self.hash(pos)]
-    
-    def save(self, posKey: int, entry: TTEntry):
-        self.table[posKey] = entry
-    
-    def clear(self):
-        self.table = [self.TTEntry() for i in range(self.size)]
-    
+        return self.probe(self.hash(pos))
+
+    def probe(self, key: int):
+        """:return: the entry for `key`, or an empty entry (`is_none()`) if there is none."""
+        first = self.first_entry(key)
+        keys = self.keys
+        self.probes += 1
+        for i in range(first, first + CLUSTER_SIZE):
+            if keys[i] == key:
+                self.hits += 1
+                self.generations[i] = self.generation  # refresh
+                value = self.values[i]
+                eval = self.evals[i]
+                return self.TTEntry(key, move=decode_move(self.moves[i]),
+                                    value=value if value != VALUE_NONE else None,
+                                    eval=eval if eval != VALUE_NONE else None,
+                                    depth=self.depths[i], bound=self.bounds[i])
+        return self.NONE_ENTRY
+
+    def save(self, key: int, move: chess.Move = None, value: int = None, eval: int = None,
+             depth: int = 0, bound: int = BOUND_NONE):
+        first = self.first_entry(key)
+        keys = self.keys
+
+        # Find the entry with the same key, or an entry to replace: the one with the lowest depth,
+        # where entries from older searches count as shallower.
+        replace = first
+        replace_score = None
+        for i in range(first, first + CLUSTER_SIZE):
+            if keys[i] == key or not keys[i]:
+                replace = i
+                break
+            age = (GENERATION_CYCLE + self.generation - self.generations[i]) % GENERATION_CYCLE
+            score = self.depths[i] - 8 * age
+            if replace_score is None or score < replace_score:
+                replace, replace_score = i, score
+
+        i = replace
+        # Preserve any existing move for the same position
+        if move is not None or keys[i] != key:
+            self.moves[i] = encode_move(move)
+        keys[i] = key
+        self.values[i] = value if value is not None else VALUE_NONE
+        self.evals[i] = eval if eval is not None else VALUE_NONE
+        self.depths[i] = max(-128, min(depth, 127))
+        self.bounds[i] = bound
+        self.generations[i] = self.generation
+
     def __str__(self):
-        return str(self.table)
-    
-    
\ No newline at end of file
+        return f"TranspositionTable({self.mb} MB, {self.size} entries)"
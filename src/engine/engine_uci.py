@@ -5,10 +5,13 @@ Special thanks to PyFish for most of the UCI code.
 import chess, chess.engine
 
 import engine_search
+import engine_engine
+import engine_bench
+import engine_utils as utils
 from engine_ucioption import *
 from engine_timeman import Time
 
-import threading, sys
+import threading, sys, queue
 
 
 # constants
@@ -41,29 +44,78 @@ def fen_from_str(s: str):
     return [fen, rest]
 
 
-def handle_commands():
+class SearchController:
+    """
+    Owns the search thread. The input loop only starts and signals searches, and never waits for one to
+    finish, except before starting the next one or changing the state the search uses (e.g. the hash).
+    """
+    def __init__(self):
+        self.thread = None
+
+    def searching(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, pos: chess.Board, MAX_MOVES, MAX_ITERS, movetime, nodes, tm: Time, ponder: bool = False):
+        self.wait()
+        started = threading.Event()
+        self.thread = threading.Thread(target=engine_search.search_main, args=(pos,),
+                                       kwargs=dict(MAX_MOVES=MAX_MOVES, MAX_ITERS=MAX_ITERS, movetime=movetime,
+                                                   nodes=nodes, timeman=tm, started=started, ponder=ponder),
+                                       name="search", daemon=True)
+        self.thread.start()
+        # A `stop` that arrives before the search is initialised must not be lost
+        started.wait()
+
+    def ponderhit(self):
+        """The expected move was played: the ponder search goes on as a normal search."""
+        if self.searching():
+            engine_search.ponderhit()
+
+    def stop(self):
+        """Signal the search to stop; it sends `bestmove` as soon as it has unwound."""
+        if self.searching():
+            engine_search.stop_search()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def read_input(commands: queue.Queue):
+    """Reader thread: put every line of input on the command queue, and `quit` at the end of the input."""
+    try:
+        for line in sys.stdin:
+            commands.put(line.strip())
+    finally:
+        commands.put("quit")
+
+
+def handle_commands(commands: queue.Queue):
     pos = chess.Board()
-    search_thread = None
+    search = SearchController()
     
-    try:
-        while True:
-            try:
-                command = sys.stdin.readline().strip()
-            except Exception:
-                break
+    while True:
+        # One bad command (e.g. an invalid FEN or move) is reported, and the engine keeps reading
+        try:
+            command = commands.get()
                 
             tm = Time()  # initialize new timeman object
             
             if command == "uci":
-                print(f"id name PVplayer")
-                print(f"id author the PVplayer developers (see AUTHORS file)\n")
+                utils.send(f"id name PVplayer")
+                utils.send(f"id author the PVplayer developers (see AUTHORS file)\n")
                 # UCI options
-                print(options_str())
-                print("uciok")
+                utils.send(options_str())
+                utils.send("uciok")
             elif command == "isready":
-                print("readyok")
+                # answered at once, even during a search
+                utils.send("readyok")
             elif command == "ucinewgame":
                 pos = chess.Board()
+                search.stop()
+                search.wait()
+                engine_search.clear()
             elif command == "position startpos":
                 pos = chess.Board()
             elif command.startswith("position startpos moves"):
@@ -71,8 +123,9 @@ def handle_commands():
                     moves = command.split("position startpos moves ")[1].split(" ")
                 except IndexError:
                     moves = []
+                pos = chess.Board()
                 for move in moves:
-                    pos.push(uci_to_move(move))
+                    pos.push(pos.parse_uci(move))
             elif command.startswith("position fen") and "moves" in command:
                 # remove 'position fen '
                 s = ' '.join(command.split(" ")[2:])
@@ -80,7 +133,7 @@ def handle_commands():
                 moves = fen_from_str(s)[1].split()[1:]
                 pos = chess.Board(fen)
                 for move in moves:
-                    pos.push(uci_to_move(move))
+                    pos.push(pos.parse_uci(move))
             elif command.startswith("position fen"):
                 s = ' '.join(command.split(" ")[2:])
                 fen = fen_from_str(s)[0]
@@ -115,22 +168,27 @@ def handle_commands():
                     wtime, btime, winc, binc = process_time(args)
                     tm.__init__(wtime, btime, winc, binc)
                     
-                # we do not support time controls yet.
-                # we also do not support pondering.
+                # `go ponder`: search the position after the expected reply, on the opponent's time
+                ponder = "ponder" in args
                 
                 # start search
-                search_thread = threading.Thread(target=start_search, args=(pos, option("MAX_MOVES"), MAX_ITERS, 
-                                                                            movetime, nodes, tm))
-                search_thread.start()
+                search.start(pos, option("MAX_MOVES"), MAX_ITERS, movetime, nodes, tm, ponder)
+                
+            elif command == "bench" or command.startswith("bench "):
+                search.stop()
+                search.wait()
+                engine_bench.bench(*engine_bench.parse_args(command.split()[1:]))
                 
             # quit and stop
             elif command == "quit":
-                exit()
+                search.stop()
+                search.wait()
+                engine_engine.close_evaluators()
+                return
             elif command == "stop":
-                if search_thread:
-                    engine_search.stop_search()
-                    search_thread.join()
-                    search_thread = None
+                search.stop()
+            elif command == "ponderhit":
+                search.ponderhit()
             
             # option setting
             elif command.startswith("setoption"):
@@ -148,31 +206,24 @@ def handle_commands():
                 
                 # set the option
                 setoption(name, value)
-    except KeyboardInterrupt:
-        exit()
-            
-
-def start_search(pos, MAX_MOVES, MAX_ITERS, time, nodes, tm):
-    engine_search.search_main(pos, MAX_MOVES=MAX_MOVES, MAX_ITERS=MAX_ITERS, movetime=time, nodes=nodes, timeman=tm)
+        except KeyboardInterrupt:
+            search.stop()
+            search.wait()
+            engine_engine.close_evaluators()
+            return
+        except Exception as e:
+            utils.send(f"info string Error in command '{command}': {e!r}")
     
     
 def uci():
     """
-    Start the UCI interface.
+    Start the UCI interface: a reader thread feeds the command queue, which is handled on this thread.
     """
-    print("PVplayer chess engine")
-    
-    # Create a thread for handling UCI input
-    uci_thread = threading.Thread(target=handle_commands)
-    uci_thread.start()
+    utils.send("PVplayer chess engine")
     
-    while True:
-        uci_thread.join(timeout=0.1)
-        
-        if not uci_thread.is_alive():
-            # Reset the UCI thread for the next iteration
-            uci_thread = threading.Thread(target=handle_commands)
-            uci_thread.start()
+    commands = queue.Queue()
+    threading.Thread(target=read_input, args=(commands,), name="input", daemon=True).start()
+    handle_commands(commands)
         
         
 # Helper functions
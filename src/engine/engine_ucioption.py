@@ -21,13 +21,13 @@ class Option:
             self.func = func
         
         def set(self, value: str):
-            value = bool(value.lower())
+            value = value.lower() == "true"
             self.value = value
             if self.func:
                 self.func()
         
         def __str__(self):
-            return f"option name {self.name} type check default {self.default}"
+            return f"option name {self.name} type check default {str(self.default).lower()}"
     
     class Spin:
         """Numerical value."""
@@ -115,10 +115,12 @@ options = {
     "Nodes": Option.Spin("Nodes", 1, 0, 1<<24),
     "debug": Option.Check("debug", False),
     
-    "Threads": Option.Spin("Threads", 1, 1, 1024),
-    "Hash": Option.Spin("Hash", 1<<15, 1, 1<<25),
+    "Threads": Option.Spin("Threads", 1, 1, 1024),  # PVengine search threads, each with its own evaluator
+    "Engine Threads": Option.Spin("Engine Threads", 1, 1, 1024),  # threads of each external engine
+    "Hash": Option.Spin("Hash", 16, 1, 1<<16),  # in MB
     
     "Move Overhead": Option.Spin("Move Overhead", 100, 0, 5000),
+    "Ponder": Option.Check("Ponder", False),
 }
 
 
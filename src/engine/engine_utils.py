@@ -2,6 +2,9 @@ import chess, chess.engine
 import datetime
 import yaml
 
+import sys
+import threading
+
 ROOT_BOARD = None
 
 PGN_TEXT = f"""[Event "PVplayer analysis"]
@@ -175,3 +178,13 @@ def nodes_to_str(nodes: int):
 def clamp(value, min_value, max_value):
     return max(min(value, max_value), min_value)
 
+
+OUTPUT_LOCK = threading.Lock()
+
+
+def send(message: str):
+    """Write a line of UCI output and flush it at once, so that it does not sit in a pipe buffer.
+    The input and search threads both write, so lines are written under a lock and never interleave."""
+    with OUTPUT_LOCK:
+        sys.stdout.write(message + "\n")
+        sys.stdout.flush()
@@ -1,29 +1,182 @@
-import random
-import chess
+import chess, chess.polyglot
 from chess import Board
-from engine_ucioption import *
+
+RANDOM = chess.polyglot.POLYGLOT_RANDOM_ARRAY
+HASHER = chess.polyglot.ZobristHasher(RANDOM)
+TURN_KEY = RANDOM[780]
+
+
+def zobrist_hash(position: Board):
+    """The full 64-bit Polyglot key of a position."""
+    if isinstance(position, Position):
+        return position.key
+    return chess.polyglot.zobrist_hash(position)
+
 
 class Zobrist:
-    def __init__(self):
-        self.pieces = [[0 for i in range(64)] for j in range(12)]
-        for i in range(12):
-            for j in range(64):
-                self.pieces[i][j] = random.randint(0, 2 ** 64 - 1)
-        self.side = random.randint(0, 2 ** 64 - 1)
-        self.en_passant = [random.randint(0, 2 ** 64 - 1) for i in range(8)]
-        self.castling = [random.randint(0, 2 ** 64 - 1) for i in range(16)]
-    
+    """Polyglot Zobrist hashing. The keys are full 64-bit, so they can be used for TT verification."""
     def hash(self, position: Board):
-        h = 0
-        for i in range(64):
-            piece = position.piece_at(i)
-            if piece is not None:
-                h ^= self.pieces[piece.piece_type][i]
-        if position.turn == chess.BLACK:
-            h ^= self.side
-        if position.ep_square is not None:
-            h ^= self.en_passant[position.board.ep_square % 8]
-        for i in range(16):
-            if position.has_castling_rights(i):
-                h ^= self.castling[i]
-        return h % option("Hash")
\ No newline at end of file
+        return zobrist_hash(position)
+
+
+class Position(Board):
+    """
+    A board that keeps its Polyglot Zobrist key (`key`) up to date incrementally.
+    Only the squares touched by a move are rehashed on `push`, and `pop` restores the previous key,
+    so getting the key of a position costs nothing.
+    """
+    def __init__(self, fen=chess.STARTING_FEN, *, chess960: bool = False):
+        self.key = 0
+        self._keys = []
+        super().__init__(fen, chess960=chess960)
+
+    @classmethod
+    def from_board(cls, board: Board):
+        """Create a Position with the same root position and move stack as `board`."""
+        pos = cls(board.root().fen(), chess960=board.chess960)
+        for move in board.move_stack:
+            pos.push(move)
+        return pos
+
+    def clear_stack(self):
+        # Called whenever the position is set up from scratch, so recompute the key here
+        super().clear_stack()
+        self._keys = []
+        self.key = chess.polyglot.zobrist_hash(self)
+
+    def _piece_key(self, square: chess.Square):
+        piece_type = self.piece_type_at(square)
+        if not piece_type:
+            return 0
+        color = bool(self.occupied_co[chess.WHITE] & chess.BB_SQUARES[square])
+        return RANDOM[64 * ((piece_type - 1) * 2 + color) + square]
+
+    def push(self, move: chess.Move):
+        key = self.key
+        castling_rights = self.castling_rights
+
+        # Squares whose contents may change
+        if self.is_castling(move):
+            squares = chess.SquareSet(chess.BB_RANK_1 if self.turn == chess.WHITE else chess.BB_RANK_8)
+        elif self.is_en_passant(move):
+            squares = (move.from_square, move.to_square, self.ep_square ^ 8)
+        else:
+            squares = (move.from_square, move.to_square)
+
+        for square in squares:
+            key ^= self._piece_key(square)
+        key ^= HASHER.hash_ep_square(self)
+        old_castling = HASHER.hash_castling(self) if castling_rights else 0
+
+        self._keys.append(self.key)
+        super().push(move)
+
+        for square in squares:
+            key ^= self._piece_key(square)
+        key ^= HASHER.hash_ep_square(self) ^ TURN_KEY
+        if castling_rights != self.castling_rights:
+            key ^= old_castling ^ HASHER.hash_castling(self)
+
+        self.key = key
+
+    def pop(self):
+        move = super().pop()
+        self.key = self._keys.pop()
+        return move
+
+    def copy(self, *, stack=True):
+        board = super().copy(stack=stack)
+        board.key = self.key
+        if stack:
+            stack = len(self.move_stack) if stack is True else stack
+            board._keys = self._keys[-stack:] if stack else []
+        return board
+
+    def root(self):
+        board = super().root()
+        board.key = chess.polyglot.zobrist_hash(board)
+        return board
+
+
+def _legacy_hash(position: Board, pieces, side, en_passant, castling):
+    """The previous full-board hash, kept only for the benchmark below."""
+    h = 0
+    for i in range(64):
+        piece = position.piece_at(i)
+        if piece is not None:
+            h ^= pieces[piece.piece_type][i]
+    if position.turn == chess.BLACK:
+        h ^= side
+    if position.ep_square is not None:
+        h ^= en_passant[position.ep_square % 8]
+    for i in range(16):
+        if position.has_castling_rights(i):
+            h ^= castling[i]
+    return h
+
+
+def bench(nodes: int = 20000, seed: int = 1):
+    """Micro-benchmark: cost of hashing per node (push + key + pop) along random games.
+    The old search hashed every node twice with a full-board scan."""
+    import random
+    from time import perf_counter
+
+    rng = random.Random(seed)
+    pieces = [[rng.getrandbits(64) for _ in range(64)] for _ in range(12)]
+    side, en_passant = rng.getrandbits(64), [rng.getrandbits(64) for _ in range(8)]
+    castling = [rng.getrandbits(64) for _ in range(16)]
+
+    # Collect a list of (position, move) pairs from random games
+    samples = []
+    board = chess.Board()
+    while len(samples) < nodes:
+        moves = list(board.legal_moves)
+        if not moves or board.ply() > 200:
+            board = chess.Board()
+            continue
+        move = rng.choice(moves)
+        samples.append((board.copy(stack=False), move))
+        board.push(move)
+
+    def run(name, f):
+        start = perf_counter()
+        for pos, move in samples:
+            f(pos, move)
+        elapsed = perf_counter() - start
+        print(f"{name:<28} {elapsed / nodes * 1e6:8.2f} us/node")
+
+    def legacy(pos, move):
+        pos.push(move)
+        _legacy_hash(pos, pieces, side, en_passant, castling)
+        _legacy_hash(pos, pieces, side, en_passant, castling)
+        pos.pop()
+
+    def baseline(pos, move):
+        pos.push(move)
+        pos.pop()
+
+    def polyglot(pos, move):
+        pos.push(move)
+        chess.polyglot.zobrist_hash(pos)
+        pos.pop()
+
+    def incremental(pos, move):
+        pos.push(move)
+        pos.key
+        pos.pop()
+
+    run("push/pop only (no hashing)", baseline)
+    run("before (2x full scan)", legacy)
+    run("polyglot (1x full scan)", polyglot)
+    samples = [(Position(pos.fen()), move) for pos, move in samples]
+    run("incremental (Position)", incremental)
+
+    # Sanity check: the incremental keys match the Polyglot keys
+    for pos, move in samples[:1000]:
+        pos.push(move)
+        assert pos.key == chess.polyglot.zobrist_hash(pos), pos.fen()
+        pos.pop()
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,166 @@
+import chess, chess.pgn
+import yaml
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+
+import engine
+import utils.utils as utils
+import query_tb as query_tb
+import PV_trace
+
+
+def read_positions(path: str):
+    """
+    Read the positions to analyse from a file:
+    - PGN (.pgn): the final position of each game
+    - EPD/FEN: one position per line; empty lines and lines starting with '#' are skipped
+    :return: a generator of (index, id, fen)
+    """
+    if path.lower().endswith(".pgn"):
+        with open(path, "r") as f:
+            index = 0
+            while True:
+                game = chess.pgn.read_game(f)
+                if game is None:
+                    break
+                board = game.end().board()
+                yield index, game.headers.get("Event", str(index)), board.fen()
+                index += 1
+        return
+
+    with open(path, "r") as f:
+        index = 0
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                board = chess.Board(line)
+                id_ = str(index)
+            except ValueError:
+                board, ops = chess.Board.from_epd(line)
+                id_ = str(ops.get("id", index))
+            yield index, id_, board.fen()
+            index += 1
+
+
+def read_done(path: str):
+    """:return: the indices of the positions already in the output file, so that a crashed run can resume.
+    Positions that failed are not counted as done, and are retried."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:  # the last line may be cut off by a crash
+                continue
+            if "error" not in record:
+                done.add(record["index"])
+    # Terminate a cut off last line, so that it does not corrupt the next record
+    with open(path, "rb+") as f:
+        if f.seek(0, os.SEEK_END) and (f.seek(-1, os.SEEK_END), f.read(1))[1] != b"\n":
+            f.write(b"\n")
+    return done
+
+
+def default_workers():
+    """One worker per `Threads` engine threads, so that the engines do not oversubscribe the CPU."""
+    threads = int((engine.engine_options or {}).get("Threads", 1))
+    return max(1, (os.cpu_count() or 1) // max(1, threads))
+
+
+def _init_worker(verbose: bool):
+    utils.__init__()
+    utils.export_pgn = False
+    query_tb.__init__()
+    if not verbose:
+        sys.stdout = open(os.devnull, "w")
+    # Engines keep the process alive, so shut them down when the pool exits the worker
+    multiprocessing.util.Finalize(None, engine.close, exitpriority=10)
+    multiprocessing.util.Finalize(None, query_tb.close, exitpriority=10)
+
+
+def _trace(index: int, id_: str, fen: str, kwargs: dict):
+    """Worker: trace one position. The engines of the worker are kept warm between positions."""
+    start = perf_counter()
+    record = {"index": index, "id": id_, "fen": fen}
+    try:
+        result = PV_trace.tracePV(fen, **kwargs)
+    except Exception as e:
+        record["error"] = repr(e)
+        engine.close()  # it may be the engine that failed, start from a fresh one
+    else:
+        record.update(moves=result["moves"], evals=result["evals"], tb_eval=result["tb_eval"],
+                      final_fen=result["fen"])
+    record["time"] = round(perf_counter() - start, 3)
+    return record
+
+
+def run_batch(input_path: str, output_path: str, workers: int = None, verbose: bool = False, **kwargs):
+    """
+    Trace every position of `input_path` in a pool of worker processes, each with its own engines.
+    Results are appended to `output_path` (JSON lines) as soon as they finish, in completion order.
+    Positions that are already in `output_path` are skipped, so an interrupted run can just be restarted.
+    """
+    kwargs["print_board"] = False
+    kwargs["on_info"] = None
+    kwargs["timing_path"] = None  # the positions would overwrite each other's summary
+    workers = workers or default_workers()
+
+    done = read_done(output_path)
+    positions = [p for p in read_positions(input_path) if p[0] not in done]
+    print(f"{len(done)} positions already done, {len(positions)} to go, {workers} workers")
+    if not positions:
+        return
+
+    start = perf_counter()
+    count = errors = 0
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker,
+                             initargs=(verbose,)) as executor, open(output_path, "a") as out:
+        futures = [executor.submit(_trace, index, id_, fen, kwargs) for index, id_, fen in positions]
+        for future in as_completed(futures):
+            record = future.result()
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+
+            count += 1
+            if "error" in record:
+                errors += 1
+                status = f"error: {record['error']}"
+            else:
+                status = f"eval: {record['evals'][-1]['eval_']}" if record["evals"] else "no moves"
+            print(f"[{count}/{len(positions)}] {record['id']} | {record['time']}s | {status}")
+
+    elapsed = perf_counter() - start
+    print(f"Done: {count} positions ({errors} errors) in {elapsed:.1f}s, {count / elapsed:.2f} positions/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Trace the PV of every position in an EPD/FEN/PGN file.")
+    parser.add_argument("input", help="EPD or FEN file (one position per line), or PGN file (final positions)")
+    parser.add_argument("output", help="JSONL output file; an existing file is resumed")
+    parser.add_argument("-w", "--workers", type=int, default=0,
+                        help="number of worker processes (default: CPU count / engine Threads)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of the traces")
+    args = parser.parse_args()
+
+    with open("config.yml", "r") as f:
+        config = yaml.safe_load(f)
+        kwargs = PV_trace.read_config(config)
+        workers = args.workers or int(config.get("BATCH_WORKERS", 0))
+
+    run_batch(args.input, args.output, workers=workers, verbose=args.verbose, **kwargs)
+
+
+if __name__ == "__main__":
+    main()
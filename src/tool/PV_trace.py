@@ -1,19 +1,78 @@
-import chess, chess.engine
+import chess, chess.engine, chess.pgn
 import yaml
 
+import asyncio
+import contextlib
+import datetime
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import engine
 import utils.utils as utils
+from utils.recorder import TraceRecorder
+from utils.position import PositionTracker
+from budget import AdaptiveBudget
+import timing
 import print_board as printBoard
+import PV_tree
 import query_tb as query_tb
 
-def tracePV(startfen: str, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int=None, time:int=None, mate:int=None,
-            print_board=True, stop_on_tbhit=True, query_on_tbhit=True,
-            stop_on_draw=0, stop_on_eval=0):
+async def trace_pv(startfen: str, pool=None, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int=None,
+                   time:int=None, mate:int=None, print_board=True, stop_on_tbhit=True, query_on_tbhit=True,
+                   stop_on_draw=0, stop_on_eval=0, verbose=True, on_info=None, early_exit: engine.EarlyExit=None,
+                   budget: AdaptiveBudget=None, continuous=False, recorder: TraceRecorder=None,
+                   timer: timing.PhaseTimer=None):
     """
     'Trace' the PV of a given FEN and keep calculating the next PV. This repeats until the end of the game
     or until the maximum number of iterations is reached.
+    This is the asyncio core: it keeps all of its state locally, so many traces can run concurrently on one
+    event loop, sharing an `engine.AsyncEnginePool` (default: the global pool, on the engine loop).
+    If `on_info` is given, it is called with every intermediate info line of the engine, as it arrives.
+    If `early_exit` is given, an iteration ends as soon as its policy says the result is stable.
+    If `budget` is given, it replaces the fixed per-iteration limits: the trace spends its total budget,
+    giving more to the iterations that need it.
+    If `continuous` is set, one engine is reserved for the whole trace, so that its hash carries over
+    between iterations. The time to reach each depth is recorded.
+    If `recorder` is given, every iteration is added to its PGN as soon as it is done.
+    If `timer` is given, the wall time of each phase is recorded, and its summary is added to the result
+    (`timing`).
+    :return: dict with the traced moves (UCI), the eval after each iteration, the final FEN and the tablebase eval
     """
-    board = chess.Board(startfen)
+    if pool is None:
+        pool = engine.get_pool()
+    if budget is not None:
+        budget = budget.copy()  # the budget is per trace
+    result = {"startfen": startfen, "moves": [], "evals": [], "tb_eval": None, "fen": startfen}
+
+    timer_token = timing.CURRENT.set(timer) if timer is not None else None
+    try:
+        async with engine.EngineSession(pool) if continuous else contextlib.nullcontext(pool) as pool:
+            return await _trace_pv(result, startfen, pool, MAX_MOVES=MAX_MOVES, MAX_ITER=MAX_ITER, depth=depth,
+                                   nodes=nodes, time=time, mate=mate, print_board=print_board,
+                                   stop_on_tbhit=stop_on_tbhit, query_on_tbhit=query_on_tbhit,
+                                   stop_on_draw=stop_on_draw, stop_on_eval=stop_on_eval, verbose=verbose,
+                                   on_info=on_info, early_exit=early_exit, budget=budget, continuous=continuous,
+                                   recorder=recorder, timer=timer)
+    finally:
+        if timer is not None:
+            result["timing"] = timer.summary()
+            timing.CURRENT.reset(timer_token)
+
+
+async def _trace_pv(result: dict, startfen: str, pool, MAX_MOVES, MAX_ITER, depth, nodes, time, mate, print_board,
+                    stop_on_tbhit, query_on_tbhit, stop_on_draw, stop_on_eval, verbose, on_info, early_exit,
+                    budget, continuous, recorder, timer):
+    """The iterations of `trace_pv`, adding to `result`. `pool` is the engine session in continuous mode."""
+    log = print if verbose else lambda *args: None
+    
+    # One board with the whole game from `startfen`: the engine is sent all of it, so that it is not
+    # blind to threefold repetition, even across iterations.
+    tracker = PositionTracker(chess.Board(startfen))
+    board = tracker.board
+    if tracker.is_game_over():  # e.g. the final position of a decisive game: there is no PV to trace
+        log("Game over, stopping!")
+        return result
     
     if not depth:
         depth = None
@@ -25,23 +84,35 @@ def tracePV(startfen: str, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int
         mate = None
     
     # if no parameters are given, default to 2M nodes
-    if not depth and not nodes and not time and not mate:
+    if not depth and not nodes and not time and not mate and budget is None:
         nodes = 2000000
+    limit = chess.engine.Limit(depth=depth, nodes=nodes, time=time, mate=mate)
         
     i = 1
     drawn_moves_count = 0
     
     while i <= MAX_ITER:
-        if not utils.ROOT_BOARD:
-            info: chess.engine.InfoDict = engine.__engine__(fen=board.fen(), depth=depth, nodes=nodes, time=time, mate=mate)
-        else:
-            info: chess.engine.InfoDict = engine.__engine__(depth=depth, nodes=nodes, time=time, mate=mate)
+        if timer is not None:
+            timer.iteration(i)
+        if budget is not None:
+            if budget.exhausted():
+                log(f"Budget exhausted ({budget}), stopping!")
+                return result
+            limit = budget.limit(board, MAX_ITER - i + 1)
+        
+        with timing.phase("analyse"):
+            if on_info is None and not early_exit and not continuous:
+                info: chess.engine.InfoDict = await pool.analyse(board, limit)
+            else:
+                info: chess.engine.InfoDict = await pool.analyse_streaming(board, limit, on_info=on_info,
+                                                                           early_exit=early_exit)
         
         pv = info["pv"]
         # only take the first MAX_MOVES of the pv because it can be increasingly unreliable
         pv = pv[:MAX_MOVES]
         
         # other related info
+        raw_info = dict(info)  # before the values are formatted below
         score_is_mate = info["score"].is_mate()
         score = info["score"] = utils.cp_to_score(info["score"])  # type: str
         
@@ -51,48 +122,74 @@ def tracePV(startfen: str, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int
         _nps = info["nps"] = utils.nodes_to_str(info["nps"])  # type: str
         _time = info["time"]
 
-        board = utils.push_pv(board, pv, info)
+        n = len(board.move_stack)
+        with timing.phase("play_pv"):
+            tracker.play(pv)
+            record_moves(result, tracker, n, eval_=score, depth=_depth, seldepth=_seldepth, nodes=_nodes)
+        if recorder is not None:
+            with timing.phase("pgn"):
+                recorder.push_iteration(board.move_stack[n:], info)
+        if continuous and info.get("depth_times"):
+            result["evals"][-1]["depth_times"] = info["depth_times"]
+            log(f"Iteration {i} | Time to depth {_depth}: {info['depth_times'].get(_depth)}s")
+        if budget is not None:
+            budget.update(raw_info, len(board.move_stack) - n)
+            log(f"Iteration {i} | Budget spent: {budget}")
         
-        print(f"Iteration {i} | Eval: {score} | depth: {_depth}/{_seldepth} | nodes: {_nodes} (nps {_nps}) | time: {_time}s")
-        print(f"Iteration {i} | Traced FEN: {board.fen()}")
-        if print_board:
-            printBoard.printBoard(board.fen())
+        log(f"Iteration {i} | Eval: {score} | depth: {_depth}/{_seldepth} | nodes: {_nodes} (nps {_nps}) | time: {_time}s"
+            + (" | stopped early" if info.get("early_exit") else "") + (" | cached" if info.get("cached") else ""))
+        log(f"Iteration {i} | Traced FEN: {tracker.fen()}")
+        if print_board and verbose:
+            with timing.phase("print board"):
+                printBoard.printBoard(board.fen())
             
-        if board.is_game_over(claim_draw=True):
-            print("Game over, stopping!")
-            return
+        if tracker.is_game_over():
+            log("Game over, stopping!")
+            return result
 
         # Query tablebase if possible
         if query_on_tbhit and len(board.piece_map()) <= 7:
-            print("Tablebase position reached (<= 7 pieces), querying...")
-            # Get eval
-            tb_info = query_tb.query_tablebase_eval(board)
+            log("Tablebase position reached (<= 7 pieces), querying...")
+            # Get eval (the tablebase providers are blocking, so run them in a thread)
+            with timing.phase("tablebase"):
+                tb_info = await asyncio.to_thread(query_tb.query_tablebase_eval, board)
             if tb_info is None:
-                print("Tablebase error when fetching eval, stopping!")
-                return
+                log("Tablebase error when fetching eval, stopping!")
+                return result
 
-            eval_ = tb_info[0]
+            eval_ = result["tb_eval"] = tb_info[0]
             dtm = tb_info[1]
+            dtz = tb_info[2]
             if dtm:
-                print(f"Tablebase eval: {eval_} (DTM {dtm})")
+                log(f"Tablebase eval: {eval_} (DTM {dtm})")
+            elif dtz:
+                log(f"Tablebase eval: {eval_} (DTZ {dtz})")
             else:
-                print(f"Tablebase eval: {eval_}")
+                log(f"Tablebase eval: {eval_}")
 
             # Get best line (until end of game)
-            print("Querying best line... This may take a while.")
-            tb_pv = query_tb.query_tablebase_pv(board)
+            log("Querying best line... This may take a while.")
+            with timing.phase("tablebase"):
+                tb_pv = await asyncio.to_thread(query_tb.query_tablebase_pv, board)
             if tb_pv is None:
-                print("Tablebase error when fetching best line, stopping!")
-                return
+                log("Tablebase error when fetching best line, stopping!")
+                return result
 
-            board = utils.push_pv(board, tb_pv, is_tb=True)
-            print(f"Traced FEN: {board.fen()}")
-            if print_board:
-                printBoard.printBoard(board.fen())
+            n = len(board.move_stack)
+            with timing.phase("play_pv"):
+                tracker.play(tb_pv)
+                record_moves(result, tracker, n, eval_=eval_, tb=True)
+            if recorder is not None:
+                with timing.phase("pgn"):
+                    recorder.push_tablebase(board.move_stack[n:])
+            log(f"Traced FEN: {tracker.fen()}")
+            if print_board and verbose:
+                with timing.phase("print board"):
+                    printBoard.printBoard(board.fen())
                 
         if stop_on_tbhit and len(board.piece_map()) <= 7:
-            print("Tablebase position reached (<= 7 pieces), stopping!")
-            return
+            log("Tablebase position reached (<= 7 pieces), stopping!")
+            return result
         
         
         if utils.is_drawn_score(score):
@@ -102,19 +199,181 @@ def tracePV(startfen: str, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int
         
         if stop_on_draw:
             if drawn_moves_count >= stop_on_draw:
-                print(f"Drawn for {drawn_moves_count} consecutive iterations, stopping!")
-                return
+                log(f"Drawn for {drawn_moves_count} consecutive iterations, stopping!")
+                return result
         if stop_on_eval:
             if score_is_mate or abs(utils.score_to_cp(score)) >= abs(stop_on_eval):
-                print(f"Eval exceeded threshold: {stop_on_eval}, stopping!")
-                return
+                log(f"Eval exceeded threshold: {stop_on_eval}, stopping!")
+                return result
         
+        if timer is not None:
+            timer.end_iteration()
+            log(f"Iteration {i} | Timing: {timer.breakdown()}")
         i += 1
-        
+
+    return result
+
+
+def tracePV(startfen: str, MAX_MOVES=20, MAX_ITER=100, depth:int=None, nodes:int=None, time:int=None, mate:int=None,
+            print_board=True, stop_on_tbhit=True, query_on_tbhit=True,
+            stop_on_draw=0, stop_on_eval=0, on_info=None, early_exit: engine.EarlyExit=None,
+            budget: AdaptiveBudget=None, continuous=False, timing_path: str=None):
+    """
+    'Trace' the PV of a given FEN (see `trace_pv`), using the global engine pool.
+    If PGN export is enabled, the PGN is written to the pgns directory as the trace goes.
+    If `timing_path` is given, the time spent in each phase is written there as JSON at the end.
+    :return: dict with the traced moves (UCI), the eval after each iteration, the final FEN and the tablebase eval
+    """
+    timer = timing.PhaseTimer() if timing_path else None
+    recorder = None
+    if utils.export_pgn:
+        recorder = TraceRecorder(startfen, utils.pgn_path(), detailed=utils.detailed_pgn)
+        print(f"Writing PGN to {recorder.path}")
+    try:
+        return engine.run(trace_pv(startfen, MAX_MOVES=MAX_MOVES, MAX_ITER=MAX_ITER, depth=depth, nodes=nodes,
+                                   time=time, mate=mate, print_board=print_board, stop_on_tbhit=stop_on_tbhit,
+                                   query_on_tbhit=query_on_tbhit, stop_on_draw=stop_on_draw,
+                                   stop_on_eval=stop_on_eval, on_info=on_info, early_exit=early_exit,
+                                   budget=budget, continuous=continuous, recorder=recorder, timer=timer))
+    finally:
+        if recorder is not None:
+            recorder.close()
+            print(f"PGN written to {recorder.path}")
+        if timer is not None:
+            timer.write(timing_path)
+            print(f"Timing summary written to {timing_path}")
+
+
+def print_info(info: chess.engine.InfoDict):
+    """An `on_info` callback that shows the progress of the current iteration."""
+    if info.get("multipv", 1) != 1 or "score" not in info:
+        return
+    print(f"  depth {info.get('depth')}/{info.get('seldepth')} | eval {utils.cp_to_score(info['score'])}"
+          f" | nodes {utils.nodes_to_str(info.get('nodes', 0))} | nps {utils.nodes_to_str(info.get('nps', 0))}"
+          f" | pv {utils.pv_to_uci(info['pv'][:8])}")
+
+
+def record_moves(result: dict, tracker: PositionTracker, n: int, **info):
+    """Add the moves pushed on the tracker's board since its `n`th move to the trace result."""
+    moves = [m.uci() for m in tracker.board.move_stack[n:]]
+    result["moves"] += moves
+    result["evals"].append(dict(ply=len(result["moves"]), **info))
+    result["fen"] = tracker.fen()
+
+
+def root_moves(startfen: str, k: int, depth: int=None, nodes: int=None, time: int=None, mate: int=None):
+    """:return: the top `k` root moves of a position as a list of (move, score) from a MultiPV search."""
+    if not depth and not nodes and not time and not mate:
+        nodes = 2000000
+    limit = chess.engine.Limit(depth=depth or None, nodes=nodes or None, time=time or None, mate=mate or None)
+    infos = engine.analyse(chess.Board(startfen), limit, multipv=k)
+    return [(info["pv"][0], utils.cp_to_score(info["score"])) for info in infos if info.get("pv")]
+
+
+def _trace_root_move(startfen: str, move: str, kwargs: dict):
+    """Worker: trace the PV after a root move. Runs in its own process, with its own engine pool."""
+    utils.__init__()
+    utils.export_pgn = False  # the PGN is built by the parent from the returned results
+    query_tb.__init__()
+    
+    board = chess.Board(startfen)
+    board.push_uci(move)
+    if kwargs.get("timing_path"):
+        # one summary per root move
+        stem, ext = os.path.splitext(kwargs["timing_path"])
+        kwargs = dict(kwargs, timing_path=f"{stem}-{move}{ext}")
+    try:
+        result = tracePV(board.fen(), **kwargs)
+    finally:
+        engine.close()
+        query_tb.close()
+    result["root_move"] = move
+    return result
+
+
+def trace_root_moves(startfen: str, k: int, workers: int=None, **kwargs):
+    """
+    Root-split tracing: find the top `k` root moves, then trace the PV after each of them in parallel.
+    Each root move is traced by its own worker process with its own engine, so the traces do not share
+    (or wait for) an engine. The results are merged into a single PGN with one variation per root move.
+    :return: the list of trace results, in root move order
+    """
+    kwargs.setdefault("print_board", False)
+    kwargs["on_info"] = None  # the workers' progress would be interleaved
+    moves = root_moves(startfen, k, depth=kwargs.get("depth"), nodes=kwargs.get("nodes"),
+                       time=kwargs.get("time"), mate=kwargs.get("mate"))
+    # The root engine is not needed anymore; free the CPU for the workers
+    engine.close()
+    if not moves:
+        print("No legal moves in the root position, nothing to trace!")
+        return []
+    print(f"Root moves: {', '.join(f'{move.uci()} ({score})' for move, score in moves)}")
+    
+    # spawn, so that workers do not inherit the parent's engine threads
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers or len(moves), mp_context=ctx) as executor:
+        futures = [executor.submit(_trace_root_move, startfen, move.uci(), kwargs) for move, _ in moves]
+        results = [future.result() for future in futures]
+    
+    for (move, score), result in zip(moves, results):
+        result["root_score"] = score
+        print(f"Root move {move.uci()} ({score}) | {len(result['moves'])} moves traced |"
+              f" final eval: {result['evals'][-1]['eval_'] if result['evals'] else None}")
+    return results
+
+
+def merge_root_traces(startfen: str, results: list):
+    """Merge root-split trace results into a PGN game: the first root move is the main line,
+    the others are variations. Each iteration's eval is added as a comment where it ended."""
+    game = chess.pgn.Game()
+    game.headers["Event"] = "PVplayer analysis"
+    game.headers["Site"] = "https://github.com/XInTheDark/PVplayer"
+    game.headers["Date"] = datetime.datetime.now().strftime('%Y.%m.%d')
+    game.setup(chess.Board(startfen))
     
+    for result in results:
+        node = game.add_variation(chess.Move.from_uci(result["root_move"]))
+        node.comment = f"{result['root_score']}"
+        evals = {e["ply"]: e for e in result["evals"]}
+        for ply, move in enumerate(result["moves"], start=1):
+            node = node.add_variation(chess.Move.from_uci(move))
+            e = evals.get(ply)
+            if e is not None and utils.detailed_pgn:
+                node.comment = f"{e['eval_']}, tablebase" if e.get("tb") else f"{e['eval_']}, depth {e['depth']}"
+    return game
+
+
+def read_config(config: dict):
+    """:return: the tracePV keyword arguments set in config.yml"""
+    # Adaptive mode: a total budget for the whole trace, instead of fixed limits per iteration
+    budget_nodes = int(config.get("BUDGET_NODES", 0))
+    budget_time = float(config.get("BUDGET_TIME", 0))
+    budget = AdaptiveBudget(nodes=budget_nodes or None, time=budget_time or None) \
+        if budget_nodes or budget_time else None
     
+    return dict(depth=int(config["DEPTH"]),
+                nodes=int(config["NODES"]),
+                time=int(config["TIME"]),
+                mate=int(config["MATE"]),
+                MAX_MOVES=int(config["MAX_MOVES"]),
+                MAX_ITER=int(config["MAX_ITER"]),
+                print_board=bool(config["PRINT_BOARD"]),
+                stop_on_tbhit=bool(config["STOP_ON_TBHIT"]),
+                query_on_tbhit=bool(config["QUERY_ON_TBHIT"]),
+                stop_on_draw=int(config["STOP_ON_DRAW"]),
+                stop_on_eval=int(config["STOP_ON_EVAL"]),
+                on_info=print_info if config.get("PRINT_INFO", True) else None,
+                early_exit=engine.EarlyExit(stable_depths=int(config.get("EARLY_EXIT_DEPTHS", 0)),
+                                            converge_cp=int(config.get("EARLY_EXIT_CP", 0)),
+                                            min_depth=int(config.get("EARLY_EXIT_MIN_DEPTH", 1))),
+                budget=budget,
+                continuous=bool(config.get("CONTINUOUS", False)),
+                timing_path=config.get("TIMING_FILE") or None)
+
+
 def main():
     utils.__init__()
+    query_tb.__init__()
     
     startfen = input("FEN > ")
     if not startfen:
@@ -125,25 +384,198 @@ def main():
     
     with open("config.yml", "r") as f:
         config = yaml.safe_load(f)
-        depth = int(config["DEPTH"])
-        nodes = int(config["NODES"])
-        time = int(config["TIME"])
-        mate = int(config["MATE"])
-        max_moves = int(config["MAX_MOVES"])
-        max_iter = int(config["MAX_ITER"])
-        print_board = bool(config["PRINT_BOARD"])
-        stop_on_tbhit = bool(config["STOP_ON_TBHIT"])
-        query_on_tbhit = bool(config["QUERY_ON_TBHIT"])
-        stop_on_draw = int(config["STOP_ON_DRAW"])
-        stop_on_eval = int(config["STOP_ON_EVAL"])
-        
-        
-    tracePV(startfen, depth=depth, nodes=nodes, time=time, mate=mate, MAX_MOVES=max_moves, MAX_ITER=max_iter,
-            print_board=print_board, stop_on_tbhit=stop_on_tbhit, query_on_tbhit=query_on_tbhit,
-            stop_on_draw=stop_on_draw, stop_on_eval=stop_on_eval)
-    utils.write_pgn()
+        kwargs = read_config(config)
+        # Root-split: trace the top ROOT_MOVES root moves in parallel
+        root_moves_count = int(config.get("ROOT_MOVES", 1))
+        root_workers = int(config.get("ROOT_WORKERS", 0))
+        # Tree mode: branch into the MultiPV lines within MULTIPV_MARGIN cp of the best
+        multipv = int(config.get("MULTIPV", 1))
+        multipv_margin = int(config.get("MULTIPV_MARGIN", 30))
+        tree_nodes = int(config.get("TREE_NODES", 0))
+    
+    if multipv > 1:
+        try:
+            root = PV_tree.traceTree(startfen, multipv=multipv, margin=multipv_margin, budget_nodes=tree_nodes,
+                                     parallel=engine.ENGINE_POOL_SIZE, MAX_MOVES=kwargs["MAX_MOVES"],
+                                     MAX_ITER=kwargs["MAX_ITER"], depth=kwargs["depth"], nodes=kwargs["nodes"],
+                                     time=kwargs["time"], mate=kwargs["mate"],
+                                     query_on_tbhit=kwargs["query_on_tbhit"])
+        finally:
+            engine.close()
+            query_tb.close()
+        utils.write_pgn(str(PV_tree.to_pgn(root)))
+        return
+    
+    if root_moves_count > 1:
+        try:
+            results = trace_root_moves(startfen, root_moves_count, workers=root_workers, **kwargs)
+        finally:
+            engine.close()
+            query_tb.close()
+        utils.write_pgn(str(merge_root_traces(startfen, results)))
+        return
+    
+    try:
+        tracePV(startfen, **kwargs)
+    finally:
+        engine.close()
+        query_tb.close()
     
     
     
+class _BlockingPool:
+    """Adapts the `SimpleEngine` pool to `trace_pv`: each call blocks the calling thread, like the old driver."""
+    def __init__(self, pool: engine.EnginePool):
+        self.pool = pool
+
+    async def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        return self.pool.analyse(board, limit, **kwargs)
+
+
+def bench(traces: int=16, concurrency: int=4, **kwargs):
+    """
+    Compare the throughput of concurrent traces with one thread per engine (`SimpleEngine`, the old driver)
+    and with all engines on one asyncio event loop. Both use `concurrency` engines.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from time import perf_counter
+
+    fens = [
+        chess.STARTING_FEN,
+        "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+    ]
+    fens = [fens[i % len(fens)] for i in range(traces)]
+    kwargs = dict(dict(depth=10, MAX_MOVES=4, MAX_ITER=5), **kwargs,
+                  print_board=False, query_on_tbhit=False, stop_on_tbhit=False, verbose=False)
+
+    # 1. Thread per engine
+    pool = engine.EnginePool(engine.ENGINE_PATH, engine.engine_options, size=concurrency)
+    blocking = _BlockingPool(pool)
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(lambda fen: asyncio.run(trace_pv(fen, pool=blocking, **kwargs)), fens))
+    threaded = perf_counter() - start
+    pool.close()
+
+    # 2. asyncio
+    async def run_async():
+        pool = engine.AsyncEnginePool(engine.ENGINE_PATH, engine.engine_options, size=concurrency)
+        try:
+            start = perf_counter()
+            await asyncio.gather(*(trace_pv(fen, pool=pool, **kwargs) for fen in fens))
+            return perf_counter() - start
+        finally:
+            await pool.close()
+    asynchronous = asyncio.run(run_async())
+
+    print(f"{traces} traces, {concurrency} engines")
+    print(f"thread per engine: {threaded:.2f}s ({traces / threaded:.2f} traces/s)")
+    print(f"asyncio:           {asynchronous:.2f}s ({traces / asynchronous:.2f} traces/s)")
+
+
+def bench_continuous(startfen: str=chess.STARTING_FEN, depth: int=20, iterations: int=5, **kwargs):
+    """
+    Measure how much of the engine's hash carries over between iterations in continuous mode:
+    the same trace is run with the hash cleared (`ucinewgame`) before every iteration, then with the hash kept.
+    Both send the whole game, so the only difference is the hash.
+    """
+    kwargs = dict(dict(MAX_MOVES=4), **kwargs, depth=depth, MAX_ITER=iterations, print_board=False,
+                  query_on_tbhit=False, stop_on_tbhit=False, verbose=False, continuous=True)
+
+    async def run(newgame: bool):
+        pool = engine.AsyncEnginePool(engine.ENGINE_PATH, engine.engine_options, newgame=newgame)
+        try:
+            return await trace_pv(startfen, pool=pool, **kwargs)
+        finally:
+            await pool.close()
+
+    cold = asyncio.run(run(newgame=True))
+    warm = asyncio.run(run(newgame=False))
+
+    print(f"Time to depth {depth} per iteration (s)")
+    print("iteration   hash cleared   hash kept")
+    total_cold = total_warm = 0
+    for i, (c, w) in enumerate(zip(cold["evals"], warm["evals"]), start=1):
+        if "depth_times" not in c or "depth_times" not in w:
+            continue
+        # the last depth both reached, in case the trace stopped at a shallower depth (e.g. mate found)
+        d = min(c["depth"], w["depth"])
+        tc, tw = c["depth_times"].get(d) or 0, w["depth_times"].get(d) or 0
+        total_cold += tc
+        total_warm += tw
+        print(f"{i:>9}   {tc:>12.2f}   {tw:>9.2f}")
+    if total_cold:
+        print(f"total       {total_cold:>12.2f}   {total_warm:>9.2f}   ({1 - total_warm / total_cold:.0%} saved)")
+    if cold["moves"] != warm["moves"]:
+        print("note: the traces diverged, so later iterations searched different positions")
+
+
+def profile(func, path: str="PV_trace.prof"):
+    """
+    Run `func()` under cProfile and write the stats (pstats format) to `path`.
+    The traces run on the engine loop thread, so it is profiled as well, and merged into the same stats.
+    """
+    import cProfile
+    import pstats
+    import sys
+
+    profiler = cProfile.Profile()
+    if sys.version_info >= (3, 12):
+        # cProfile is built on sys.monitoring, which covers every thread, and only one profiler can be active
+        profiler.enable()
+        try:
+            return func()
+        finally:
+            profiler.disable()
+            write_profile(pstats.Stats(profiler), path)
+
+    # Before 3.12, a profiler only hooks the thread it is enabled or disabled on
+    loop_profiler = cProfile.Profile()
+
+    async def profile_loop(enable: bool):
+        loop_profiler.enable() if enable else loop_profiler.disable()
+
+    close = engine.close
+
+    def close_profiled():
+        # Disable the loop profiler while the loop still runs
+        if engine.LOOP is not None:
+            engine.run(profile_loop(False))
+        close()
+
+    engine.run(profile_loop(True))
+    engine.close = close_profiled
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        engine.close = close
+        if engine.LOOP is not None:
+            engine.run(profile_loop(False))
+        stats = pstats.Stats(profiler)
+        stats.add(loop_profiler)
+        write_profile(stats, path)
+
+
+def write_profile(stats, path: str):
+    stats.dump_stats(path)
+    stats.sort_stats("cumulative").print_stats(20)
+    print(f"Profile written to {path}")
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    import sys
+    args = [arg for arg in sys.argv[1:] if arg != "--profile"]
+    if args and args[0] == "bench":
+        command = lambda: bench(*map(int, args[1:3]))
+    elif args and args[0] == "bench-continuous":
+        command = lambda: bench_continuous(chess.STARTING_FEN, *map(int, args[1:3]))
+    else:
+        command = main
+    if "--profile" in sys.argv:
+        profile(command)
+    else:
+        command()
@@ -0,0 +1,200 @@
+import chess, chess.engine, chess.pgn
+
+import asyncio
+import datetime
+import heapq
+import itertools
+
+import engine
+import utils.utils as utils
+from utils.position import PositionTracker
+import query_tb as query_tb
+
+MATE_SCORE = 100000
+TB_SCORES = {"win": MATE_SCORE // 2, "cursed-win": 0, "draw": 0, "blessed-loss": 0, "loss": -MATE_SCORE // 2}
+
+
+class TreeNode:
+    """A traced line: the moves from the parent node, and the engine's eval at the end of them."""
+    def __init__(self, tracker: PositionTracker, parent=None, moves: list=(), gap: int=0):
+        self.tracker = tracker
+        self.board = tracker.board  # the position at the end of the line, with all moves from the root on its stack
+        self.parent = parent
+        self.moves = list(moves)
+        self.gap = gap  # how much worse this line is than the best one of the parent, in cp
+        self.level = parent.level + 1 if parent is not None else 0
+
+        self.children = []
+        self.expanded = False
+        self.eval = None  # cp, from white's POV
+        self.eval_str = None
+        self.depth = None
+        self.tb = None  # tablebase category
+        self.transposition = None  # the node with the same position, elsewhere in the tree
+        self.end = None  # why the line was not expanded further
+
+    def uncertainty_cost(self):
+        """The scheduler expands the leaf with the lowest cost first: lines close to the best one,
+        near the root, with a non-decisive eval."""
+        return self.gap + 10 * self.level + max(0, abs(self.eval or 0) - 200) // 4
+
+    def value(self):
+        """:return: the minimax value of the node, in cp from white's POV"""
+        if self.tb is not None:
+            return TB_SCORES.get(self.tb, 0) * (1 if self.board.turn == chess.WHITE else -1)
+        if self.transposition is not None:
+            return self.transposition.eval
+        if not self.children:
+            return self.eval
+        values = [child.value() for child in self.children]
+        values = [v for v in values if v is not None]
+        if not values:
+            return self.eval
+        return max(values) if self.board.turn == chess.WHITE else min(values)
+
+    def count(self):
+        return 1 + sum(child.count() for child in self.children)
+
+
+async def trace_tree(startfen: str, pool=None, multipv: int=3, margin: int=30, MAX_MOVES=20, MAX_ITER=100,
+                     depth: int=None, nodes: int=None, time: int=None, mate: int=None, budget_nodes: int=None,
+                     parallel: int=1, query_on_tbhit=True, verbose=True):
+    """
+    Trace a tree of lines instead of a single one. Each expansion analyses a leaf with MultiPV `multipv`,
+    and branches into every line whose score is within `margin` cp of the best. The first `MAX_MOVES` moves
+    of each line are played, and its end becomes a new leaf.
+    Leaves are expanded best-first, the most uncertain first (see `TreeNode.uncertainty_cost`), until
+    `MAX_ITER` expansions or `budget_nodes` engine nodes are spent. `parallel` leaves are expanded at a time.
+    A position reached by two lines is only expanded once, and analyses are reused across transpositions.
+    :return: the root `TreeNode`
+    """
+    if pool is None:
+        pool = engine.get_pool()
+    log = print if verbose else lambda *args: None
+
+    if not depth and not nodes and not time and not mate:
+        nodes = 2000000
+    limit = chess.engine.Limit(depth=depth or None, nodes=nodes or None, time=time or None, mate=mate or None)
+
+    root = TreeNode(PositionTracker(chess.Board(startfen)))
+    positions = {root.board.epd(): root}  # the node of each position in the tree
+    analyses = {}  # MultiPV analysis of each position, by EPD
+    leaves = []  # heap of (cost, counter, node)
+    counter = itertools.count()
+    heapq.heappush(leaves, (0, next(counter), root))
+    spent = expansions = 0
+
+    async def analyse(node: TreeNode):
+        nonlocal spent
+        key = node.board.epd()
+        if key not in analyses:
+            analyses[key] = await pool.analyse(node.board, limit, multipv=multipv)
+            spent += analyses[key][0].get("nodes", 0) if analyses[key] else 0
+        return analyses[key]
+
+    async def close_line(child: TreeNode):
+        """Check whether a new line ends here. :return: True if it should not be expanded"""
+        board = child.board
+        if child.tracker.is_game_over():
+            child.end = "game over"
+            return True
+        if len(board.piece_map()) <= 7:
+            child.end = "tablebase"
+            if query_on_tbhit:
+                tb_info = await asyncio.to_thread(query_tb.query_tablebase_eval, board)
+                if tb_info is not None:
+                    child.tb = tb_info[0]
+            return True
+        other = positions.get(board.epd())
+        if other is not None:
+            child.transposition = other
+            child.end = "transposition"
+            return True
+        positions[board.epd()] = child
+        return False
+
+    async def expand(node: TreeNode, index: int):
+        infos = await analyse(node)
+        node.expanded = True
+        infos = [info for info in infos if info.get("pv") and "score" in info]
+        if not infos:
+            node.end = "no moves"
+            return
+
+        best = infos[0]["score"].relative.score(mate_score=MATE_SCORE)
+        if node.eval is None:  # the root
+            node.eval = infos[0]["score"].white().score(mate_score=MATE_SCORE)
+            node.eval_str = utils.cp_to_score(infos[0]["score"])
+            node.depth = infos[0].get("depth")
+
+        for info in infos:
+            gap = best - info["score"].relative.score(mate_score=MATE_SCORE)
+            if gap > margin:
+                continue
+            n = len(node.board.move_stack)
+            tracker = node.tracker.copy()
+            tracker.play(info["pv"][:MAX_MOVES])
+            child = TreeNode(tracker, node, tracker.board.move_stack[n:], gap)
+            child.eval = info["score"].white().score(mate_score=MATE_SCORE)
+            child.eval_str = utils.cp_to_score(info["score"])
+            child.depth = info.get("depth")
+            node.children.append(child)
+
+            if not await close_line(child):
+                heapq.heappush(leaves, (child.uncertainty_cost(), next(counter), child))
+
+        log(f"Expansion {index} | {utils.pv_to_uci(node.board.move_stack) or 'root'} | eval {node.eval_str}"
+            f" | {len(node.children)} lines | nodes spent {utils.nodes_to_str(spent)}")
+
+    while leaves and expansions < MAX_ITER:
+        if budget_nodes and spent >= budget_nodes:
+            log(f"Node budget exhausted ({utils.nodes_to_str(spent)}), stopping!")
+            break
+        batch = [heapq.heappop(leaves)[2] for _ in range(min(parallel, len(leaves), MAX_ITER - expansions))]
+        await asyncio.gather(*(expand(node, expansions + i) for i, node in enumerate(batch, start=1)))
+        expansions += len(batch)
+
+    for _, _, node in leaves:
+        node.end = node.end or "not expanded"
+    log(f"Tree: {root.count()} lines, {expansions} expansions, {len(analyses)} positions analysed,"
+        f" eval {utils.cp_to_score(root.value()) if root.value() is not None else None}")
+    return root
+
+
+def traceTree(startfen: str, **kwargs):
+    """Blocking version of `trace_tree`, using the global engine pool."""
+    return engine.run(trace_tree(startfen, **kwargs))
+
+
+def _comment(node: TreeNode):
+    comment = f"{node.eval_str}, depth {node.depth}" if node.eval_str is not None else ""
+    if node.tb is not None:
+        comment += f", tablebase {node.tb}"
+    if node.transposition is not None:
+        comment += f", transposes to {utils.pv_to_uci(node.transposition.board.move_stack)}"
+    if node.children:
+        comment += f", tree eval {utils.cp_to_score(node.value())}"
+    return comment.lstrip(", ")
+
+
+def to_pgn(root: TreeNode):
+    """Export the tree as a PGN game: the best line is the main line, the alternatives are (nested) variations."""
+    game = chess.pgn.Game()
+    game.headers["Event"] = "PVplayer analysis"
+    game.headers["Site"] = "https://github.com/XInTheDark/PVplayer"
+    game.headers["Date"] = datetime.datetime.now().strftime('%Y.%m.%d')
+    game.setup(root.board)
+    if root.value() is not None:
+        game.comment = f"tree eval {utils.cp_to_score(root.value())}"
+
+    def add(pgn_node: chess.pgn.GameNode, node: TreeNode):
+        for child in node.children:
+            p = pgn_node
+            for move in child.moves:
+                p = p.variation(move) if p.has_variation(move) else p.add_variation(move)
+            if utils.detailed_pgn:
+                p.comment = _comment(child)
+            add(p, child)
+
+    add(game, root)
+    return game
@@ -0,0 +1,115 @@
+import chess, chess.engine, chess.polyglot
+
+import sqlite3
+import threading
+import time
+
+
+class AnalysisCache:
+    """
+    An on-disk store of engine analyses, shared across runs and processes.
+
+    Each position (EPD, with its Zobrist key for quick lookups) keeps the deepest analysis seen for each engine:
+    depth, nodes, time, score and PV. A lookup returns the stored analysis if it already satisfies the
+    requested limit, so positions reached again (in a later run, or by transposition from another trace)
+    are not searched again.
+    The database is in WAL mode, so any number of processes can read it while one writes.
+    When it holds more than `max_entries` analyses, the oldest ones are evicted.
+    """
+    EVICT_INTERVAL = 256  # check the size every this many writes
+
+    def __init__(self, path: str, max_entries: int = 1000000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.hits = self.misses = 0
+
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS analysis (
+            engine TEXT, epd TEXT, key INTEGER, depth INTEGER, seldepth INTEGER, nodes INTEGER, time REAL,
+            score_cp INTEGER, score_mate INTEGER, pv TEXT, written REAL, PRIMARY KEY (engine, epd))""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS analysis_key ON analysis (key)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS analysis_written ON analysis (written)")
+        self.db.commit()
+
+    @staticmethod
+    def key(board: chess.Board):
+        # SQLite integers are signed 64-bit
+        k = chess.polyglot.zobrist_hash(board)
+        return k - (1 << 64) if k >= 1 << 63 else k
+
+    @staticmethod
+    def usable(board: chess.Board, limit: chess.engine.Limit):
+        """Mate searches are not cached, and neither are positions that already occurred in the game:
+        the stored analysis does not know about the repetition."""
+        return not limit.mate and (limit.depth or limit.nodes or limit.time) and not board.is_repetition(2)
+
+    @staticmethod
+    def satisfies(row, limit: chess.engine.Limit):
+        """An analysis satisfies a limit if the search would have stopped there: any given limit is reached."""
+        depth, nodes, time_ = row[0], row[2], row[3]
+        return (limit.depth is not None and depth >= limit.depth) or \
+               (limit.nodes is not None and nodes >= limit.nodes) or \
+               (limit.time is not None and time_ >= limit.time)
+
+    def get(self, engine: str, board: chess.Board, limit: chess.engine.Limit):
+        """:return: the cached info for `board`, if it satisfies `limit`, else None"""
+        if not self.usable(board, limit):
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT depth, seldepth, nodes, time, score_cp, score_mate, pv FROM analysis"
+                                  " WHERE key = ? AND engine = ? AND epd = ?",
+                                  (self.key(board), engine, board.epd())).fetchone()
+        if row is None or not self.satisfies(row, limit):
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        depth, seldepth, nodes, time_, score_cp, score_mate, pv = row
+        score = chess.engine.Mate(score_mate) if score_mate is not None else chess.engine.Cp(score_cp)
+        return {"depth": depth, "seldepth": seldepth, "nodes": nodes, "time": time_,
+                "nps": int(nodes / time_) if time_ else 0,
+                "score": chess.engine.PovScore(score, board.turn),
+                "pv": [chess.Move.from_uci(move) for move in pv.split()], "cached": True}
+
+    def put(self, engine: str, board: chess.Board, limit: chess.engine.Limit, info: chess.engine.InfoDict):
+        """Store an analysis, unless a deeper one is already stored."""
+        if not self.usable(board, limit) or info.get("cached") or not info.get("pv") or "score" not in info:
+            return
+        score = info["score"].relative
+        row = (engine, board.epd(), self.key(board), info.get("depth", 0), info.get("seldepth", 0),
+               info.get("nodes", 0), info.get("time", 0.0), score.score(), score.mate(),
+               " ".join(move.uci() for move in info["pv"]), time.time())
+        with self.lock:
+            self.db.execute("""INSERT INTO analysis VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (engine, epd) DO UPDATE SET depth = excluded.depth, seldepth = excluded.seldepth,
+                nodes = excluded.nodes, time = excluded.time, score_cp = excluded.score_cp,
+                score_mate = excluded.score_mate, pv = excluded.pv, written = excluded.written
+                WHERE excluded.depth > analysis.depth
+                   OR (excluded.depth = analysis.depth AND excluded.nodes > analysis.nodes)""", row)
+            self.db.commit()
+            self.writes += 1
+            if self.writes % self.EVICT_INTERVAL == 0:
+                self._evict()
+
+    def _evict(self):
+        """Delete the oldest analyses, down to 90% of `max_entries`."""
+        count = self.db.execute("SELECT COUNT(*) FROM analysis").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        self.db.execute("DELETE FROM analysis WHERE rowid IN"
+                        " (SELECT rowid FROM analysis ORDER BY written LIMIT ?)",
+                        (count - self.max_entries * 9 // 10,))
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+    def __str__(self):
+        return f"analysis cache: {self.hits} hits, {self.misses} misses"
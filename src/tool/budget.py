@@ -0,0 +1,114 @@
+import chess, chess.engine
+
+import copy
+import math
+
+import utils.utils as utils
+
+TB_PIECES = 7  # positions with this many pieces are resolved by the tablebase
+
+
+class AdaptiveBudget:
+    """
+    Split a total node and/or time budget over the iterations of a trace, instead of spending the same
+    fixed limit on every iteration.
+
+    Each iteration gets the remaining budget divided by the number of iterations still expected, scaled by:
+    - volatility: how much the eval changed since the previous iteration. Along a PV the eval should stay
+      the same, so a jump means the previous search was not deep enough.
+    - instability: whether the engine still plays the move the previous PV predicted for this position.
+    - piece count: positions with more pieces are harder, and need more nodes for the same reliability.
+    The number of iterations still expected is bounded by the distance to the tablebase threshold,
+    estimated from the pieces captured so far, so the budget is not saved for iterations that will not happen.
+    """
+    MIN_SCALE = 0.25
+    MAX_SCALE = 4.0
+
+    def __init__(self, nodes: int = None, time: float = None, min_nodes: int = 10000):
+        self.nodes = nodes
+        self.time = time
+        self.min_nodes = min_nodes
+        self.reset()
+
+    def reset(self):
+        """Start a new trace."""
+        self.spent_nodes = 0
+        self.spent_time = 0.0
+        self.iterations = 0
+        self.start_pieces = None
+        self.scores = []
+        self.predicted = None  # the move the last PV predicted for the next position
+        self.unstable = False
+
+    def copy(self):
+        budget = copy.copy(self)
+        budget.reset()
+        return budget
+
+    def exhausted(self):
+        return (self.nodes is not None and self.spent_nodes >= self.nodes) or \
+               (self.time is not None and self.spent_time >= self.time)
+
+    def expected_iterations(self, board: chess.Board, iterations_left: int):
+        """The number of iterations still expected, including this one."""
+        pieces = len(board.piece_map())
+        if self.start_pieces is None or not self.iterations:
+            return iterations_left
+        captured_per_iteration = (self.start_pieces - pieces) / self.iterations
+        if captured_per_iteration <= 0:
+            return iterations_left
+        to_tb = math.ceil(max(0, pieces - TB_PIECES) / captured_per_iteration) + 1
+        return max(1, min(iterations_left, to_tb))
+
+    def scale(self, board: chess.Board):
+        """:return: the factor for this iteration's share of the budget"""
+        scale = 1.0
+        if len(self.scores) >= 2:
+            # 1 for a stable eval, up to 3 when it jumped by 2 pawns or more
+            scale *= 1 + min(abs(self.scores[-1] - self.scores[-2]), 200) / 100
+        if self.predicted is not None:
+            scale *= 1.5 if self.unstable else 0.75
+        # 32 pieces: 1.3, 16 pieces: 0.9, 8 pieces: 0.7
+        scale *= 0.5 + len(board.piece_map()) / 40
+        return utils.clamp(scale, self.MIN_SCALE, self.MAX_SCALE)
+
+    def limit(self, board: chess.Board, iterations_left: int):
+        """:return: the limit for the next iteration, searching `board`"""
+        if self.start_pieces is None:
+            self.start_pieces = len(board.piece_map())
+        share = self.scale(board) / self.expected_iterations(board, iterations_left)
+
+        nodes = time = None
+        if self.nodes is not None:
+            left = self.nodes - self.spent_nodes
+            nodes = int(utils.clamp(left * share, min(self.min_nodes, left), left))
+        if self.time is not None:
+            left = self.time - self.spent_time
+            time = utils.clamp(left * share, min(0.01, left), left)
+        return chess.engine.Limit(nodes=nodes, time=time)
+
+    def update(self, info: chess.engine.InfoDict, played: int):
+        """
+        Account for a finished iteration.
+        :param info: the final info of the search (with the engine's own score, nodes and time)
+        :param played: the number of PV moves that were played
+        """
+        self.iterations += 1
+        # A result from the analysis cache keeps its original nodes and time, but cost no engine time
+        if not info.get("cached"):
+            self.spent_nodes += info.get("nodes", 0)
+            self.spent_time += info.get("time", 0.0)
+        self.scores.append(info["score"].white().score(mate_score=1000))
+
+        pv = info.get("pv", [])
+        move = pv[0] if pv else None
+        self.unstable = self.predicted is not None and move != self.predicted
+        self.predicted = pv[played] if len(pv) > played else None
+
+    def __str__(self):
+        spent = []
+        if self.nodes is not None:
+            spent.append(f"{utils.nodes_to_str(self.spent_nodes)}/{utils.nodes_to_str(self.nodes)} nodes")
+        if self.time is not None:
+            spent.append(f"{self.spent_time:.1f}/{self.time:.1f}s")
+        return ", ".join(spent)
@@ -1,42 +1,491 @@
 import chess, chess.engine
 import yaml
 import utils.utils as utils
+from analysis_cache import AnalysisCache
+import timing
+
+import asyncio
+import queue
+import threading
 
 with open("src/config.yml", "r") as f:
     config = yaml.safe_load(f)
     ENGINE_PATH = config["ENGINE_PATH"]
     engine_options = config["ENGINE_OPTIONS"]
+    # Optional settings for the engine pool; older config files may not have them.
+    ENGINE_POOL_SIZE = int(config.get("ENGINE_POOL_SIZE", 1))
+    ENGINE_NEWGAME = bool(config.get("ENGINE_NEWGAME", False))
+    # Optional on-disk analysis cache, shared across runs
+    ANALYSIS_CACHE_PATH = config.get("ANALYSIS_CACHE_PATH")
+    ANALYSIS_CACHE_SIZE = int(config.get("ANALYSIS_CACHE_SIZE", 1000000))
+
+
+class EnginePool:
+    """
+    A pool of long-lived engine processes, driven through the blocking `SimpleEngine` wrapper
+    (one event loop thread per engine). The tool uses `AsyncEnginePool`; this is kept for `bench()`.
+
+    Starting an engine (loading the net, allocating the hash) is expensive, so engines are kept
+    alive across iterations and handed out on demand. Each engine is health-checked before use and
+    restarted if it has crashed.
+    If `newgame` is set, `ucinewgame` is sent before every analysis, clearing the engine's hash;
+    otherwise the hash is kept between iterations.
+    """
+    def __init__(self, path: str, options: dict, size: int = 1, newgame: bool = False):
+        self.path = path
+        self.options = options or {}
+        self.size = max(1, size)
+        self.newgame = newgame
+
+        self.idle = queue.LifoQueue()  # LIFO, so that the warmest engine is reused first
+        self.engines = []
+        self.lock = threading.Lock()
+        self.restarts = 0
+
+    def _start(self):
+        engine = chess.engine.SimpleEngine.popen_uci(self.path)
+        # Set all options at once
+        if self.options:
+            engine.configure(self.options)
+        return engine
+
+    def _restart(self, engine):
+        self._kill(engine)
+        new_engine = self._start()
+        with self.lock:
+            self.engines[self.engines.index(engine)] = new_engine
+            self.restarts += 1
+        return new_engine
+
+    @staticmethod
+    def _kill(engine):
+        try:
+            engine.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def is_alive(engine):
+        """Health check: the engine must answer `isready`."""
+        try:
+            engine.ping()
+            return True
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, TimeoutError):
+            return False
+
+    def acquire(self):
+        """Get an idle engine, starting a new one if the pool is not yet full."""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            start_new = len(self.engines) < self.size
+            if start_new:
+                self.engines.append(None)  # reserve a slot
+
+        if not start_new:
+            return self.idle.get()
+
+        try:
+            engine = self._start()
+        except Exception:
+            with self.lock:
+                self.engines.remove(None)
+            raise
+        with self.lock:
+            self.engines[self.engines.index(None)] = engine
+        return engine
+
+    def release(self, engine):
+        self.idle.put(engine)
+
+    def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        """Analyse `board` on a warm engine. If the engine crashes, it is restarted and
+        the analysis is retried once."""
+        engine = self.acquire()
+        try:
+            if not self.is_alive(engine):
+                engine = self._restart(engine)
+
+            # python-chess only sends `ucinewgame` when the game object changes
+            game = object() if self.newgame else self
+            try:
+                return engine.analyse(board, limit, game=game, **kwargs)
+            except chess.engine.EngineTerminatedError:
+                engine = self._restart(engine)
+                return engine.analyse(board, limit, game=object(), **kwargs)
+        finally:
+            self.release(engine)
+
+    def close(self):
+        with self.lock:
+            engines, self.engines = self.engines, []
+        for engine in engines:
+            if engine is None:
+                continue
+            try:
+                engine.quit()
+            except Exception:
+                self._kill(engine)
+        self.idle = queue.LifoQueue()
+
+
+class EarlyExit:
+    """
+    Policy for ending an iteration before its limit is reached, which saves engine time on easy positions.
+    The search is stopped (from `min_depth` on) once the best move has been the same for `stable_depths` depths,
+    or the score has stayed within `converge_cp` centipawns for `stable_depths` depths. 0 disables a rule.
+    """
+    def __init__(self, stable_depths: int = 0, converge_cp: int = 0, min_depth: int = 1):
+        self.stable_depths = stable_depths
+        self.converge_cp = converge_cp
+        self.min_depth = min_depth
+
+    def should_stop(self, depths: list):
+        """:param depths: (depth, best move, score in cp) for every completed depth so far"""
+        n = self.stable_depths
+        if not n or len(depths) < n or depths[-1][0] < self.min_depth:
+            return False
+        last = depths[-n:]
+        if len(set(move for _, move, _ in last)) == 1:
+            return True
+        scores = [score for _, _, score in last]
+        return bool(self.converge_cp) and max(scores) - min(scores) <= self.converge_cp
+
+    def __bool__(self):
+        return bool(self.stable_depths)
+
+
+def completed_depth(info: chess.engine.InfoDict):
+    """:return: the (depth, best move, score in cp) of an info line that ends a depth, or None"""
+    if "pv" not in info or "score" not in info or "depth" not in info or not info["pv"]:
+        return None
+    if info.get("lowerbound") or info.get("upperbound") or info.get("multipv", 1) != 1:
+        return None
+    return info["depth"], info["pv"][0], info["score"].white().score(mate_score=100000)
+
+
+class AsyncEnginePool:
+    """
+    The asyncio version of `EnginePool`, built on `chess.engine.popen_uci` (`UciProtocol`).
+    All engines are driven from a single event loop, so one thread can serve many concurrent traces.
+    A pool must only be used from the event loop it was created on.
+    If a `cache` (`AnalysisCache`) is given, analyses are looked up there first, and stored there.
+    """
+    def __init__(self, path: str, options: dict, size: int = 1, newgame: bool = False,
+                 cache: AnalysisCache = None):
+        self.path = path
+        self.options = options or {}
+        self.size = max(1, size)
+        self.newgame = newgame
+        self.cache = cache
+        self.engine_id = None  # the engine's name, known once an engine is started
+
+        self.idle = []  # LIFO, so that the warmest engine is reused first
+        self.engines = []  # (transport, protocol)
+        self.available = asyncio.Condition()
+        self.restarts = 0
+
+    async def _start(self):
+        with timing.phase("engine start"):
+            transport, protocol = await chess.engine.popen_uci(self.path)
+        self.engine_id = protocol.id.get("name", self.path)
+        if self.options:
+            with timing.phase("configure"):
+                await protocol.configure(self.options)
+        return transport, protocol
+
+    async def _restart(self, engine, session=None):
+        self._kill(engine)
+        new_engine = await self._start()
+        self.engines[self.engines.index(engine)] = new_engine
+        self.restarts += 1
+        if session is not None:
+            session.engine = new_engine
+        return new_engine
+
+    @staticmethod
+    def _kill(engine):
+        try:
+            engine[0].close()
+        except Exception:
+            pass
+
+    @staticmethod
+    async def is_alive(engine):
+        """Health check: the engine must answer `isready`."""
+        try:
+            with timing.phase("health check"):
+                await asyncio.wait_for(engine[1].ping(), 10)
+            return True
+        except (chess.engine.EngineError, chess.engine.EngineTerminatedError, asyncio.TimeoutError):
+            return False
+
+    async def acquire(self):
+        """Get an idle engine, starting a new one if the pool is not yet full."""
+        async with self.available:
+            with timing.phase("engine wait"):
+                while not self.idle and len(self.engines) >= self.size:
+                    await self.available.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.engines.append(None)  # reserve a slot
+
+        try:
+            engine = await self._start()
+        except Exception:
+            self.engines.remove(None)
+            raise
+        self.engines[self.engines.index(None)] = engine
+        return engine
+
+    async def release(self, engine):
+        async with self.available:
+            self.idle.append(engine)
+            self.available.notify()
+
+    async def cache_get(self, board: chess.Board, limit: chess.engine.Limit):
+        """Look `board` up in the cache. This is done before taking an engine, so a hit does not wait
+        for a free one."""
+        if self.engine_id is None:  # start an engine to learn its name
+            await self.release(await self.acquire())
+        with timing.phase("cache"):
+            return self.cache.get(self.engine_id, board, limit)
 
-def __engine__(fen: str=None, depth: int=None, nodes: int=None, time: int=None, mate: int=None):
+    async def analyse(self, board: chess.Board, limit: chess.engine.Limit, session=None, **kwargs):
+        """Analyse `board` on a warm engine (the engine of `session`, if given). If the engine crashes,
+        it is restarted and the analysis is retried once."""
+        # Only single-PV analyses are cached
+        use_cache = self.cache is not None and not kwargs
+        if use_cache:
+            info = await self.cache_get(board, limit)
+            if info is not None:
+                return info
+
+        engine = session.engine if session is not None else await self.acquire()
+        try:
+            if not await self.is_alive(engine):
+                engine = await self._restart(engine, session)
+
+            # python-chess only sends `ucinewgame` when the game object changes
+            game = object() if self.newgame else self
+            try:
+                info = await engine[1].analyse(board, limit, game=game, **kwargs)
+            except chess.engine.EngineTerminatedError:
+                engine = await self._restart(engine, session)
+                info = await engine[1].analyse(board, limit, game=object(), **kwargs)
+
+            if use_cache:
+                with timing.phase("cache"):
+                    self.cache.put(self.engine_id, board, limit, info)
+            return info
+        finally:
+            if session is None:
+                await self.release(engine)
+
+    async def analysis(self, board: chess.Board, limit: chess.engine.Limit, session=None, **kwargs):
+        """Analyse `board`, yielding every info line as it arrives (async generator).
+        Leaving the loop early stops the search. If the engine crashes before sending anything,
+        it is restarted and the analysis is retried once."""
+        engine = session.engine if session is not None else await self.acquire()
+        try:
+            if not await self.is_alive(engine):
+                engine = await self._restart(engine, session)
+
+            game = object() if self.newgame else self
+            try:
+                analysis = await engine[1].analysis(board, limit, game=game, **kwargs)
+            except chess.engine.EngineTerminatedError:
+                engine = await self._restart(engine, session)
+                analysis = await engine[1].analysis(board, limit, game=object(), **kwargs)
+
+            try:
+                async for info in analysis:
+                    yield info
+            finally:
+                # Stop the search if we return early, and wait for `bestmove` before releasing the engine
+                analysis.stop()
+                await analysis.wait()
+        finally:
+            if session is None:
+                await self.release(engine)
+
+    async def analyse_streaming(self, board: chess.Board, limit: chess.engine.Limit, on_info=None,
+                                early_exit: EarlyExit = None, session=None, **kwargs):
+        """
+        Like `analyse`, but the info lines are streamed: `on_info(info)` is called for every line with a PV,
+        and the search stops early when `early_exit` says so.
+        :return: the final info, as returned by `analyse`, with the time at which each depth was completed
+        (`depth_times`, in seconds)
+        """
+        use_cache = self.cache is not None and not kwargs
+        if use_cache:
+            info = await self.cache_get(board, limit)
+            if info is not None:
+                if on_info is not None:
+                    on_info(info)
+                return info
+
+        final = {}
+        depths = []
+        depth_times = final["depth_times"] = {}
+        gen = self.analysis(board, limit, session=session, **kwargs)
+        try:
+            async for info in gen:
+                if info.get("multipv", 1) == 1:
+                    final.update(info)
+                if "pv" in info and on_info is not None:
+                    on_info(info)
+                depth = completed_depth(info)
+                if depth is None:
+                    continue
+                if depths and depths[-1][0] == depth[0]:
+                    depths[-1] = depth
+                else:
+                    depths.append(depth)
+                    depth_times[depth[0]] = info.get("time")
+                if early_exit and early_exit.should_stop(depths):
+                    final["early_exit"] = True
+                    break
+        finally:
+            await gen.aclose()
+        if use_cache:
+            with timing.phase("cache"):
+                self.cache.put(self.engine_id, board, limit, final)
+        return final
+
+    async def close(self):
+        if self.cache is not None:
+            self.cache.close()
+        engines, self.engines, self.idle = self.engines, [], []
+        for engine in engines:
+            if engine is None:
+                continue
+            try:
+                await asyncio.wait_for(engine[1].quit(), 10)
+            except Exception:
+                self._kill(engine)
+
+
+class EngineSession:
+    """
+    An engine of a pool, reserved for one trace (`async with EngineSession(pool) as session`).
+    Every iteration of the trace goes to the same engine, without `ucinewgame`, so the engine's hash from
+    the previous iterations carries over: the new position is usually deep inside the previous PV.
+    It has the same `analyse`/`analyse_streaming` methods as the pool.
+    """
+    def __init__(self, pool: AsyncEnginePool):
+        self.pool = pool
+        self.engine = None
+
+    async def open(self):
+        self.engine = await self.pool.acquire()
+
+    async def close(self):
+        if self.engine is not None:
+            await self.pool.release(self.engine)
+            self.engine = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def analyse(self, board: chess.Board, limit: chess.engine.Limit, **kwargs):
+        return await self.pool.analyse(board, limit, session=self, **kwargs)
+
+    async def analyse_streaming(self, board: chess.Board, limit: chess.engine.Limit, on_info=None,
+                                early_exit: EarlyExit = None, **kwargs):
+        return await self.pool.analyse_streaming(board, limit, on_info=on_info, early_exit=early_exit,
+                                                 session=self, **kwargs)
+
+
+# The synchronous API runs the asyncio pool on a background event loop, shared by all callers.
+LOOP = None
+LOOP_THREAD = None
+POOL = None
+
+
+def get_loop():
+    """Get the background event loop, starting it if necessary."""
+    global LOOP, LOOP_THREAD
+    if LOOP is None:
+        LOOP = asyncio.new_event_loop()
+        LOOP_THREAD = threading.Thread(target=LOOP.run_forever, name="engine-loop", daemon=True)
+        LOOP_THREAD.start()
+    return LOOP
+
+
+def run(coro):
+    """Run a coroutine on the background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+
+def get_pool():
+    """Get the global engine pool, creating it if necessary. It belongs to the background event loop,
+    so it must be used through `run()` (or from coroutines running there)."""
+    global POOL
+    if POOL is None:
+        cache = AnalysisCache(ANALYSIS_CACHE_PATH, ANALYSIS_CACHE_SIZE) if ANALYSIS_CACHE_PATH else None
+        POOL = AsyncEnginePool(ENGINE_PATH, engine_options, size=ENGINE_POOL_SIZE, newgame=ENGINE_NEWGAME,
+                               cache=cache)
+    return POOL
+
+
+def analyse(board: chess.Board, limit: chess.engine.Limit, **kwargs):
+    """Analyse `board` with the global engine pool (blocking)."""
+    return run(get_pool().analyse(board, limit, **kwargs))
+
+
+def analyse_streaming(board: chess.Board, limit: chess.engine.Limit, on_info=None, early_exit: EarlyExit = None,
+                      **kwargs):
+    """`analyse` with streamed info lines and early exit (blocking); see `AsyncEnginePool.analyse_streaming`.
+    `on_info` is called from the engine thread."""
+    return run(get_pool().analyse_streaming(board, limit, on_info=on_info, early_exit=early_exit, **kwargs))
+
+
+def close():
+    """Shut down all engines in the global pool, and the background event loop."""
+    global POOL, LOOP, LOOP_THREAD
+    if POOL is not None:
+        run(POOL.close())
+        POOL = None
+    if LOOP is not None:
+        LOOP.call_soon_threadsafe(LOOP.stop)
+        LOOP_THREAD.join()
+        LOOP.close()
+        LOOP = LOOP_THREAD = None
+
+
+def __engine__(fen: str=None, depth: int=None, nodes: int=None, time: int=None, mate: int=None,
+               on_info=None, early_exit: EarlyExit=None, board: chess.Board=None):
     """
     fen: FEN string
+    board: the position with its move stack, instead of `fen`
     depth: depth to search to
     nodes: number of nodes to search
     time: time to search for
+    on_info: called with each intermediate info line
+    early_exit: policy for ending the search early
     """
-    # 1. Create a new engine
-    engine = chess.engine.SimpleEngine.popen_uci(ENGINE_PATH)
-    
-    # Set options
-    for name, value in engine_options.items():
-        engine.configure({name: value})
-    
-    # 2. Create board
-    board = chess.Board(fen)
-    
-    # 3. Create a new limit
-    limit = chess.engine.Limit(depth=depth, nodes=nodes, time=time, mate=mate)
-    
-    # 4. Evaluate with engine
+    # 1. Create board
     # We prefer to pass the entire moves list to the engine, so that it is not
     # blind to threefold repetition.
-    if fen:
-        result = engine.analyse(board, limit)
-    else:  # we use ROOT_BOARD in order to preserve move stack
-        result = engine.analyse(utils.ROOT_BOARD, limit)
-    
-    # 5. Close the engine
-    engine.quit()
-    
-    # 6. Return the info
-    return result
\ No newline at end of file
+    if board is None:
+        board = chess.Board(fen)
+
+    # 2. Create a new limit
+    limit = chess.engine.Limit(depth=depth, nodes=nodes, time=time, mate=mate)
+
+    # 3. Evaluate with engine (engines are started once and reused)
+    if on_info is not None or early_exit:
+        result = analyse_streaming(board, limit, on_info=on_info, early_exit=early_exit)
+    else:
+        result = analyse(board, limit)
+
+    # 4. Return the info
+    return result
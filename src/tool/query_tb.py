@@ -1,51 +1,244 @@
-import chess
-import requests
+import chess, chess.syzygy
+import yaml
+
+from collections import OrderedDict
+import json
+import sqlite3
+import threading
+import time
+
+try:
+    import requests
+except ImportError:  # the online tablebase is optional
+    requests = None
+
+
+class SyzygyProvider:
+    """Probe local Syzygy WDL/DTZ files.
+    `path` is a directory, or several directories separated by the OS path separator."""
+    name = "syzygy"
+
+    CATEGORIES = {2: "win", 1: "cursed-win", 0: "draw", -1: "blessed-loss", -2: "loss"}
+
+    def __init__(self, path: str):
+        self.tablebase = chess.syzygy.open_tablebase(path)
+
+    def probe(self, pos: chess.Board):
+        """:return: dict with category, wdl, dtz and dtm (always None for Syzygy), or None"""
+        try:
+            wdl = self.tablebase.probe_wdl(pos)
+            dtz = self.tablebase.probe_dtz(pos)
+        except KeyError:  # MissingTableError, or too many pieces
+            return None
+
+        return {"category": self.CATEGORIES[wdl], "wdl": wdl, "dtz": dtz, "dtm": None}
+
+    def _rank_move(self, pos: chess.Board, move: chess.Move):
+        """Rank a move by the resulting DTZ, from the point of view of the side to move. Higher is better."""
+        zeroing = pos.is_zeroing(move)
+        pos.push(move)
+        try:
+            if pos.is_checkmate():
+                return 4, 0
+            d = -self.tablebase.probe_dtz(pos)
+        finally:
+            pos.pop()
+
+        if d > 0:  # win: make progress as fast as possible
+            return (3 if d <= 100 else 2), -(1 if zeroing else d)
+        if d < 0:  # loss: hold out as long as possible
+            return (-1 if d < -100 else -2), -d
+        return 0, 0
+
+    def bestmove(self, pos: chess.Board):
+        """:return: the DTZ-optimal move, or None"""
+        pos = pos.copy(stack=False)
+        try:
+            return max(pos.legal_moves, key=lambda m: self._rank_move(pos, m), default=None)
+        except KeyError:
+            return None
+
+    def close(self):
+        self.tablebase.close()
+
+
+class LichessProvider:
+    """Query the online tablebase. https://github.com/lichess-org/lila-tablebase
+
+    A keep-alive session is used for all requests, and each position is only fetched once:
+    responses are kept in a bounded LRU cache and, if `cache_path` is given, in an SQLite file
+    that persists across runs. Both caches are keyed by EPD.
+    """
+    name = "lichess"
+
+    URL = "https://tablebase.lichess.ovh/standard"
+
+    def __init__(self, url: str = URL, timeout: float = 5, retries: int = 3, backoff: float = 0.5,
+                 cache_size: int = 4096, cache_path: str = None):
+        self.url = url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()  # the caches are shared by concurrent traces
+        self.db = None
+        if cache_path:
+            self.db = sqlite3.connect(cache_path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS tablebase (epd TEXT PRIMARY KEY, response TEXT)")
+            self.db.commit()
+
+    def _cache_get(self, epd: str):
+        if epd in self.cache:
+            self.cache.move_to_end(epd)
+            return self.cache[epd]
+        if self.db is not None:
+            row = self.db.execute("SELECT response FROM tablebase WHERE epd = ?", (epd,)).fetchone()
+            if row is not None:
+                j = json.loads(row[0])
+                self._cache_put(epd, j, persist=False)
+                return j
+        return None
+
+    def _cache_put(self, epd: str, j: dict, persist=True):
+        self.cache[epd] = j
+        self.cache.move_to_end(epd)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        if persist and self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO tablebase VALUES (?, ?)", (epd, json.dumps(j)))
+            self.db.commit()
+
+    def _fetch(self, fen: str):
+        """GET the position, retrying with exponential backoff on network errors,
+        rate limiting (429) and server errors."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                r = self.session.get(self.url, params={"fen": fen}, timeout=self.timeout)
+            except requests.RequestException:
+                continue
+            if r.status_code == 429 or r.status_code >= 500:
+                continue
+            if r.status_code != 200:
+                return None
+            try:
+                return r.json()
+            except ValueError:
+                return None
+        return None
+
+    def _get(self, pos: chess.Board):
+        epd = pos.epd()
+        with self.lock:
+            j = self._cache_get(epd)
+        if j is None:
+            j = self._fetch(pos.fen())
+            if j is not None:
+                with self.lock:
+                    self._cache_put(epd, j)
+        return j
+
+    def probe(self, pos: chess.Board):
+        j = self._get(pos)
+        try:
+            eval_ = j["category"]  # "win", "loss", "draw", etc.
+            dtm_ = j["dtm"] if not eval_ == "draw" else None
+            dtz_ = j.get("dtz")
+        except (KeyError, TypeError):
+            return None
+
+        return {"category": eval_, "wdl": None, "dtz": dtz_, "dtm": dtm_}
+
+    def bestmove(self, pos: chess.Board):
+        j = self._get(pos)
+        try:
+            pv = j["moves"]
+            return chess.Move.from_uci(pv[0]["uci"])
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    def close(self):
+        self.session.close()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+# Providers, in the order they are tried. Local tables come first, so no network is used when they exist.
+PROVIDERS = [LichessProvider()] if requests is not None else []
+
+
+def __init__():
+    """Set up the tablebase providers from config.yml."""
+    global PROVIDERS
+
+    with open("config.yml", "r") as f:
+        config = yaml.safe_load(f)
+        syzygy_path = config.get("SYZYGY_PATH")
+        tb_online = config.get("TB_ONLINE", True)
+        tb_url = config.get("TB_URL", LichessProvider.URL)
+        tb_cache_size = int(config.get("TB_CACHE_SIZE", 4096))
+        tb_cache_path = config.get("TB_CACHE_PATH")
+
+    close()
+    if syzygy_path:
+        PROVIDERS.append(SyzygyProvider(syzygy_path))
+    if tb_online and requests is not None:
+        PROVIDERS.append(LichessProvider(tb_url, cache_size=tb_cache_size, cache_path=tb_cache_path))
+
+
+def close():
+    global PROVIDERS
+    for provider in PROVIDERS:
+        provider.close()
+    PROVIDERS = []
+
+
+def query_tablebase(pos: chess.Board):
+    """Query the tablebase providers in order.
+    :return: dict with category, wdl, dtz and dtm (each may be None), or None
+    """
+    for provider in PROVIDERS:
+        result = provider.probe(pos)
+        if result is not None:
+            return result
+    return None
 
 
 def query_tablebase_eval(pos: chess.Board):
-    """Query the online tablebase for the position.
-    :return: TB evaluation, DTM (if applicable)
+    """Query the tablebase for the position.
+    :return: TB evaluation, DTM (if applicable), DTZ (if applicable)
     """
-    """https://github.com/lichess-org/lila-tablebase"""
-    
-    FEN = pos.fen()
-    LINK = "https://tablebase.lichess.ovh/standard?fen=" + FEN
-    r = requests.get(LINK, timeout=5)
-    j = r.json()
-    
-    try:
-        eval_ = j["category"]  # "win", "loss", "draw", etc.
-        dtm_ = j["dtm"] if not eval_ == "draw" else None
-    except KeyError:
+    result = query_tablebase(pos)
+    if result is None:
         return None
-    
-    return eval_, dtm_
-    
+
+    return result["category"], result["dtm"], result["dtz"]
+
 
 def query_tablebase_bestmove(pos: chess.Board):
-    """Query the online tablebase for the position.
+    """Query the tablebase providers in order.
     :return: best move
     """
-    FEN = pos.fen()
-    LINK = "https://tablebase.lichess.ovh/standard?fen=" + FEN
-    r = requests.get(LINK, timeout=5)
-    j = r.json()
-    
-    try:
-        pv = j["moves"]
-        return chess.Move.from_uci(pv[0]["uci"])
-    except KeyError:
-        return None
-    
+    for provider in PROVIDERS:
+        m = provider.bestmove(pos)
+        if m is not None:
+            return m
+    return None
+
 
 def query_tablebase_pv(board: chess.Board):
-    """Query the online tablebase for the position.
+    """Query the tablebase for the position.
     :return: best PV line
     """
-    
+
     # create duplicate board to avoid modifying the original
     pos = board.copy()
-    
+
     pv = []
     while not pos.is_game_over():
         m = query_tablebase_bestmove(pos)
@@ -56,7 +249,7 @@ def query_tablebase_pv(board: chess.Board):
         except Exception:
             # We may get an AssertionError if checkmate is reached since there is no legal move
             return pv
-    
+
         pv.append(m)
-        
+
     return pv
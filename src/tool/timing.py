@@ -0,0 +1,86 @@
+import contextlib
+import contextvars
+import json
+from time import perf_counter
+
+# The timer of the trace running in the current task, if any. asyncio tasks inherit it, so the engine pool
+# can time its phases for whichever trace is awaiting it, even with many traces on one event loop.
+CURRENT = contextvars.ContextVar("timer", default=None)
+
+
+class PhaseTimer:
+    """
+    Wall time spent in each phase of a trace (engine start-up, configure, analyse, tablebase, PGN, ...),
+    in total and per iteration. Nested phases are exclusive: the time of an inner phase (e.g. starting
+    an engine) is not counted in the outer one (e.g. analyse), so the phases add up to the wall time.
+    The rest of each iteration is reported as "other". A timer belongs to one trace, i.e. one task.
+    """
+    def __init__(self):
+        self.start = perf_counter()
+        self.totals = {}
+        self.counts = {}
+        self.iterations = []
+        self.current = None
+        self.iteration_start = None
+        self.stack = []  # [name, time spent in inner phases] of the open phases
+
+    def iteration(self, i: int):
+        """Start the breakdown of iteration `i`."""
+        self.end_iteration()
+        self.current = {"iteration": i, "phases": {}}
+        self.iteration_start = perf_counter()
+
+    def end_iteration(self):
+        if self.current is None:
+            return
+        self.current["wall"] = perf_counter() - self.iteration_start
+        self.current["phases"]["other"] = max(0.0, self.current["wall"] - sum(self.current["phases"].values()))
+        self.iterations.append(self.current)
+        self.current = None
+
+    def add(self, name: str, elapsed: float):
+        self.totals[name] = self.totals.get(name, 0.0) + elapsed
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self.current is not None:
+            self.current["phases"][name] = self.current["phases"].get(name, 0.0) + elapsed
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = perf_counter()
+        frame = [name, 0.0]
+        self.stack.append(frame)
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.stack.remove(frame)
+            if self.stack:
+                self.stack[-1][1] += elapsed
+            self.add(name, elapsed - frame[1])
+
+    def breakdown(self):
+        """:return: the last finished iteration's phases as a string, e.g. 'analyse 1.20s, pgn 0.01s'"""
+        phases = self.iterations[-1]["phases"] if self.iterations else {}
+        return ", ".join(f"{name} {elapsed:.2f}s" for name, elapsed in sorted(phases.items(), key=lambda p: -p[1]))
+
+    def summary(self):
+        """:return: the totals and the per-iteration breakdown, as a JSON-serialisable dict"""
+        self.end_iteration()
+        wall = perf_counter() - self.start
+        phases = {name: {"time": round(elapsed, 4), "calls": self.counts[name],
+                         "share": round(elapsed / wall, 4) if wall else 0.0}
+                  for name, elapsed in sorted(self.totals.items(), key=lambda p: -p[1])}
+        iterations = [dict(it, wall=round(it["wall"], 4),
+                           phases={name: round(elapsed, 4) for name, elapsed in it["phases"].items()})
+                      for it in self.iterations]
+        return {"wall": round(wall, 4), "phases": phases, "iterations": iterations}
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def phase(name: str):
+    """Time a phase for the current trace's timer; does nothing if the trace is not timed."""
+    timer = CURRENT.get()
+    return timer.phase(name) if timer is not None else contextlib.nullcontext()
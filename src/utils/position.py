@@ -0,0 +1,68 @@
+import chess, chess.polyglot
+
+
+class PositionTracker:
+    """
+    A board carrying the whole game, with what is needed to tell when the game is over in constant time.
+
+    `board.is_game_over(claim_draw=True)` replays the move stack to look for threefold repetitions, so checking
+    it after every move of a long trace is quadratic. The tracker instead keeps a table of how often each
+    position (by Zobrist hash) occurred since the last capture or pawn move: earlier positions cannot
+    occur again, so the table is cleared then. It also keeps its own rule50 count.
+    """
+    def __init__(self, board: chess.Board):
+        self.board = board  # pushed in place, so it keeps the full move stack
+        self.rule50 = board.halfmove_clock
+        self.repetitions = {}  # Zobrist hash -> occurrences since the last zeroing move
+        self._count()
+
+    def _count(self):
+        self.key = chess.polyglot.zobrist_hash(self.board)
+        self.repetitions[self.key] = self.repetitions.get(self.key, 0) + 1
+
+    def copy(self):
+        tracker = PositionTracker.__new__(PositionTracker)
+        tracker.board = self.board.copy()
+        tracker.rule50 = self.rule50
+        tracker.key = self.key
+        tracker.repetitions = dict(self.repetitions)
+        return tracker
+
+    def push(self, move: chess.Move):
+        if self.board.is_zeroing(move):
+            self.rule50 = 0
+            self.repetitions.clear()
+        else:
+            self.rule50 += 1
+        self.board.push(move)
+        self._count()
+
+    def play(self, pv):
+        """
+        Push the moves of `pv`, stopping when the game is over.
+        :return: the number of moves pushed
+        """
+        n = 0
+        for move in pv:
+            self.push(move)
+            n += 1
+            if self.is_game_over():
+                break
+        return n
+
+    def is_repetition(self, count: int = 3):
+        """:return: whether the current position occurred at least `count` times"""
+        return self.repetitions[self.key] >= count
+
+    def is_game_over(self):
+        """Like `board.is_game_over(claim_draw=True)`, for the positions that actually occurred:
+        checkmate, stalemate, insufficient material, threefold repetition or 50 moves without a capture
+        or pawn move."""
+        return self.rule50 >= 100 or self.is_repetition(3) or self.board.is_insufficient_material() or \
+            not any(self.board.generate_legal_moves())
+
+    def fen(self):
+        """:return: the FEN of the current position, with the tracker's rule50 count"""
+        f = self.board.fen().split()
+        f[-2] = str(self.rule50)
+        return ' '.join(f)
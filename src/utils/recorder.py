@@ -0,0 +1,78 @@
+import chess, chess.pgn
+import datetime
+
+
+class TraceRecorder:
+    """
+    Records the moves of one trace, both as a `chess.pgn.Game` (`game`) and, if a path is given, as a PGN file
+    that is written as the trace goes: every iteration is flushed to the file as soon as it is pushed,
+    so nothing is lost if the trace is interrupted.
+    Each trace has its own recorder, so traces running at the same time do not share any state.
+    """
+    def __init__(self, startfen: str, path: str = None, detailed: bool = False):
+        self.board = chess.Board(startfen)
+        self.detailed = detailed
+
+        self.game = chess.pgn.Game()
+        self.game.headers["Event"] = "PVplayer analysis"
+        self.game.headers["Site"] = "https://github.com/XInTheDark/PVplayer"
+        self.game.headers["Date"] = datetime.datetime.now().strftime('%Y.%m.%d')
+        self.game.setup(self.board)
+        self.node = self.game
+
+        self.path = path
+        self.file = None
+        self.number_next = True  # the next move needs a move number, even if it is black's
+        if path is not None:
+            self.file = open(path, "w")
+            for key, value in self.game.headers.items():
+                self.file.write(f"[{key} \"{value}\"]\n")
+            self.file.write("\n")
+            self.file.flush()
+
+    def _push(self, moves: list, starting_comment: str = None, comment: str = None):
+        text = []
+        if starting_comment:
+            text.append(f"{{ {starting_comment} }}")
+            self.number_next = True
+        for i, move in enumerate(moves):
+            san = self.board.san(move)
+            if self.board.turn == chess.WHITE:
+                text.append(f"{self.board.fullmove_number}. {san}")
+            elif self.number_next:
+                text.append(f"{self.board.fullmove_number}... {san}")
+            else:
+                text.append(san)
+            self.number_next = False
+
+            self.board.push(move)
+            self.node = self.node.add_main_variation(move)
+            if i == 0 and starting_comment:
+                self.node.starting_comment = starting_comment
+        if comment:
+            self.node.comment = comment
+            text.append(f"{{ {comment} }}")
+            self.number_next = True
+
+        if self.file is not None and text:
+            self.file.write(" ".join(text) + " ")
+            self.file.flush()
+
+    def push_iteration(self, moves: list, info: dict):
+        """Add the moves played in an iteration. With `detailed`, the engine's info is added as a comment.
+        `info` has the formatted score and nodes, as printed by the trace."""
+        comment = None
+        if self.detailed:
+            comment = f"{info['score']}, depth {info['depth']}/{info['seldepth']}, {info['nodes']} nodes"
+        self._push(moves, comment=comment)
+
+    def push_tablebase(self, moves: list):
+        """Add a tablebase line."""
+        self._push(moves, starting_comment="Start of tablebase PV")
+
+    def close(self, result: str = "*"):
+        self.game.headers["Result"] = result
+        if self.file is not None:
+            self.file.write(f"{result}\n\n")
+            self.file.close()
+            self.file = None